@@ -1,14 +1,27 @@
 
 
 import csv
+import gzip
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from array import array
+from functools import partial
+from multiprocessing import Pool
 
 import pandas as pd
-from src import utils
+from src import kreport, outofcore, parse_cache, streams, utils
+from src.abundance import SparseTable
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
+# Buffer size of the output files.
+BUFFER_SIZE = 1024 * 1024
+
+# The columns identifying each row.
+LABELS = ["name", "taxid", "rank"]
+
 
 def map_name(name, files, delim='\t'):
     "Maps a column name to an index after checking if it is the same across files."
@@ -32,112 +45,221 @@ def colnames(fnames):
     return names
 
 
-def print_kreport(df, outdir=None, rank='', colidx=0, summary=False):
+def write_table(table, path=None, fmt='csv'):
+    """
+    Writes a sparse table, csv is made dense one block of rows at a time.
+    """
+    if fmt == 'csv':
+        table.write_csv(path or sys.stdout, names=LABELS)
+    else:
+        utils.write_table(table.to_frame(LABELS), path=path, fmt=fmt)
+
+
+def print_kreport(table, outdir=None, rank='', colidx=0, summary=False, fmt='csv', compress=False):
 
     rankmap = dict(S="Species", G="Genus", F='Family', C='Class', D='Domain')
     ranks = rank or 'SGFCD'
     colmap = {0: "percent", 1: "numreads", 2: "uniquereads"}
     pd.set_option('display.expand_frame_repr', False)
 
-    def write_to(dataframe, fname):
-        path = sys.stdout if not outdir else os.path.join(str(outdir), fname)
-        dataframe.to_csv(index=False, path_or_buf=path)
+    def write_to(subset, fname):
+        fname = os.path.splitext(fname)[0] + utils.extension(fmt)
+
+        if not outdir:
+            write_table(subset, fmt=fmt)
+            return
+
+        path = os.path.join(str(outdir), fname)
+        if fmt != 'csv':
+            write_table(subset, path=path, fmt=fmt)
+            return
+
+        # Buffered, optionally compressed, text streams.
+        if compress:
+            stream = gzip.open(path + '.gz', 'wt', compresslevel=6)
+        else:
+            stream = open(path, 'wt', buffering=BUFFER_SIZE)
+        with stream:
+            write_table(subset, path=stream)
         return
 
     # Print a summary of all taxonomic levels.
     if summary:
-        write_to(dataframe=df, fname=f'summary_{colmap.get(colidx, "")}_classification.csv')
-        return
+        tasks = [(table, f'summary_{colmap.get(colidx, "")}_classification.csv')]
+    else:
+        # Partition the rows by rank in a single pass.
+        tasks = []
+        for rank, subset in zip(ranks, table.partition(2, ranks)):
+            label = rankmap.get(rank, 'Unknown')
+            tasks.append((subset, f'{label.lower()}_{colmap.get(colidx, "")}_classification.csv'))
+
+    # Standard out is written in order, files are written concurrently.
+    if not outdir:
+        for subset, fname in tasks:
+            write_to(subset, fname)
+    else:
+        with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+            for future in [pool.submit(write_to, subset, fname) for subset, fname in tasks]:
+                future.result()
 
-    # Print a summary file for each taxonomic level.
-    for rank in ranks:
-        subset = utils.get_subset(df, rank)
-        label = rankmap.get(rank, 'Unknown')
-        write_to(dataframe=subset, fname=f'{label.lower()}_{colmap.get(colidx, "")}_classification.csv')
 
+def parse_ktable(fname, colidx=0, skip_zeros=False):
+    """
+    Parses a k-report into (name, taxid, rank) keys and an array of values.
 
-def generate_ktable(files, colidx=0):
-    "Generate table compatible with k-report"
+    With skip_zeros the rows without reads are dropped at the byte level,
+    made for reports created with --report-zero-counts.
+    """
+    if skip_zeros:
+        keys, values = [], array('d')
+        for rank, (names, taxids, columns) in kreport.read(fname).items():
+            # Keep only known rank codes
+            if rank == '-':
+                continue
+            keys.extend((name, str(taxid), rank) for name, taxid in zip(names, taxids))
+            values.extend(columns[colidx])
+        return keys, values
+
+    stream = csv.reader(open(fname, 'rt'), delimiter="\t")
+    # Keep only known rank codes
+    stream = filter(lambda x: x[3] != '-', stream)
+    # Collect all data into a dictionary keyed by keyID
+    data = dict()
+    for row in stream:
+        data[row[4].strip()] = [elem.strip() for elem in row]
+
+    keys = [tuple(reversed(fields[3:])) for fields in data.values()]
+    values = array('d', [float(fields[colidx]) for fields in data.values()])
+    return keys, values
+
+
+def parse_table(fname, keyidx, has_header=True):
+    """
+    Parses a tab delimited report into (name, taxid, rank) keys and an array of values.
+    """
+    stream = csv.reader(open(fname, 'rt'), delimiter="\t")
+    if has_header:
+        next(stream)
 
-    storage, allkeys = [], {}
+    keys, values = [], array('d')
+    for row in stream:
+        keys.append(tuple(row[0:3]))
+        values.append(float(row[keyidx]))
+    return keys, values
 
-    for fname in files:
-        stream = csv.reader(open(fname, 'rt'), delimiter="\t")
-        # Keep only known rank codes
-        stream = filter(lambda x: x[3] != '-', stream)
-        # Collect all data into a dictionary keyed by keyID
-        data = dict()
-        for row in stream:
-            data[row[4].strip()] = [elem.strip() for elem in row]
-        storage.append(data)
-        # Collect all keys across all data.
-        allkeys.update(data)
 
-    table = []
-    for key, fields in allkeys.items():
-        collect = list(reversed(fields[3:]))
+def packed(func, fname, **kwargs):
+    """
+    Runs a parser and packs the keys into a single string for the trip back from a worker.
+    """
+    keys, values = func(fname, **kwargs)
+    text = "\n".join("\t".join(key) for key in keys)
+    return text, values
 
-        for data in storage:
-            value = data.get(key, [0] * (colidx+1))[colidx]
-            value = float(value)
-            collect.append(value)
-        table.append(collect)
 
-    return table
+def unpack(text, values):
+    keys = [tuple(line.split("\t")) for line in text.split("\n")] if values else []
+    return keys, values
 
 
-def generate_table(files, keyidx, has_header=True):
+def load(func, fname, cachedir=None, **kwargs):
+    """
+    Runs a parser and packs the result, through the parse cache when a cache directory is set.
+    """
+    if cachedir:
+        return parse_cache.fetch(cachedir, fname, partial(packed, func), tag=func.__name__, **kwargs)
+    return packed(func, fname, **kwargs)
 
-    name_dict = dict()
 
-    for fname in files:
-        stream = csv.reader(open(fname, 'rt'), delimiter="\t")
-        if has_header:
-            next(stream)
-        for row in stream:
-            key = ','.join(row[0:3])
-            colidx = colnames(files).index(colnames([fname])[0])
-            value = float(row[keyidx])
-            name_dict.setdefault(key, []).append((colidx, value))
+def iter_files(func, files, jobs=1, cachedir=None, **kwargs):
+    """
+    Parses each file with func, in a process pool when jobs > 1.
+    The results are generated in the order of the files, at most twice
+    as many as there are processes wait to be read.
+    """
+    if jobs <= 1 and not cachedir:
+        yield from (func(fname, **kwargs) for fname in files)
+        return
 
-    table = []
-    for name, value in name_dict.items():
-        swap = [float(0)] * len(colnames(files))
-        for col, val in value:
-            swap[col] = val
-        table.append(name.split(',') + swap)
+    work = partial(load, func, cachedir=cachedir, **kwargs)
 
-    return table
+    if jobs <= 1:
+        yield from (unpack(text, values) for text, values in map(work, files))
+        return
+
+    with Pool(processes=jobs) as pool:
+        for text, values in streams.imap(pool, work, files, size=streams.window(jobs)):
+            yield unpack(text, values)
 
 
-def tabulate(files, keyidx=4, cutoff=0, has_header=True, is_kreport=False):
+def parse_files(func, files, jobs=1, cachedir=None, **kwargs):
     """
-    Summarize result found in data_dir by grouping them.
+    Parses all files, the results are in the order of the files.
     """
+    return list(iter_files(func, files, jobs=jobs, cachedir=cachedir, **kwargs))
+
 
-    # The final table that can be printed and further analyzed
+def generate_ktable(files, colidx=0, jobs=1, cachedir=None, skip_zeros=False):
+    "Generate table compatible with k-report"
+
+    parsed = parse_files(parse_ktable, files, jobs=jobs, cachedir=cachedir, colidx=colidx, skip_zeros=skip_zeros)
+    columns = range(len(files))
+
+    # Reports are matched by taxid.
+    return SparseTable.build(parsed, colidx=columns, columns=colnames(files), by=1)
+
+
+def generate_table(files, keyidx, has_header=True, jobs=1, cachedir=None):
+
+    parsed = parse_files(parse_table, files, jobs=jobs, cachedir=cachedir, keyidx=keyidx, has_header=has_header)
+
+    # Files with the same name share a column.
+    names = colnames(files)
+    columns = [names.index(name) for name in names]
+
+    return SparseTable.build(parsed, colidx=columns, columns=names)
+
+
+def combine(files, keyidx=4, cutoff=0, has_header=True, is_kreport=False, jobs=1, cachedir=None,
+            skip_zeros=False):
+    """
+    Combines the files into a sparse table filtered by the cutoff and sorted
+    by reverse of the rank and the abundance.
+    """
     if is_kreport:
-        table = generate_ktable(files=files, colidx=keyidx)
+        table = generate_ktable(files=files, colidx=keyidx, jobs=jobs, cachedir=cachedir, skip_zeros=skip_zeros)
     else:
-        table = generate_table(files=files, keyidx=keyidx ,has_header=has_header)
+        table = generate_table(files=files, keyidx=keyidx, has_header=has_header, jobs=jobs, cachedir=cachedir)
 
-    # Filter table by cutoffs
-    cond1 = lambda row: sum(row[3:]) > cutoff
-    table = list(filter(cond1, table))
+    return table.select(cutoff=cutoff, sort_by=2)
 
-    # Sort by reverse of the abundance.
-    compare = lambda row: (row[2], sum(row[3:]))
-    table = sorted(table, key=compare, reverse=True)
 
-    # Make a panda dataframe
-    columns = ["name", "taxid", "rank"] + colnames(files)
-    df = pd.DataFrame(table, columns=columns)
+@contextmanager
+def combine_external(files, keyidx=4, cutoff=0, has_header=True, is_kreport=False, jobs=1,
+                     cachedir=None, skip_zeros=False, budget=outofcore.BUDGET):
+    """
+    Same rows as combine() but merged on disk within a memory budget in megabytes.
+    The rows can be written while the context is open.
 
-    # Attempt to fill in common names at species level.
-    #fname = "/export/refs/alias/fishalias.txt"
-    #df = utils.alias(df=df, fname=fname, key1='name', key2='sciname', name='name')
+    The budget covers the buffered entries, with jobs > 1 up to twice as
+    many parsed files as processes may be held on top of it.
+    """
+    names = colnames(files)
+    if is_kreport:
+        # Reports are matched by taxid.
+        func, by, kwargs = parse_ktable, 1, dict(colidx=keyidx, skip_zeros=skip_zeros)
+        columns = range(len(files))
+    else:
+        # Files with the same name share a column.
+        func, by, kwargs = parse_table, None, dict(keyidx=keyidx, has_header=has_header)
+        columns = [names.index(name) for name in names]
 
-    return df
+    parsed = iter_files(func, files, jobs=jobs, cachedir=cachedir, **kwargs)
+
+    with outofcore.ExternalTable(columns=names, by=by, budget=budget) as store:
+        for col, (keys, values) in zip(columns, parsed):
+            store.add(keys, values, col)
+        yield store.select(lambda total, present: total > cutoff, sort_by=2)
 
 
 def main():
@@ -165,9 +287,27 @@ def main():
     parser.add_argument('--outdir', dest='outdir', type=str,
                         help="Directory name to write data out to." )
 
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help="Number of processes parsing the files default=%(default)s.")
+
     parser.add_argument('--summary', dest='summary', action='store_true', default=False,
                         help="Generates a summary file with all of the taxonomic levels.")
 
+    parser.add_argument('--format', dest='format', default='csv', choices=utils.FORMATS,
+                        help="Output format default=%(default)s.")
+
+    parser.add_argument('--compress', dest='compress', action='store_true', default=False,
+                        help="Gzip the csv files written to --outdir.")
+
+    parser.add_argument('--cache', dest='cache', type=str,
+                        help="Directory of parsed reports, unchanged reports are not parsed again.")
+
+    parser.add_argument('--skip_zeros', dest='skip_zeros', action='store_true', default=False,
+                        help="Skip the kreport rows without reads, faster on reports made with --report-zero-counts.")
+
+    parser.add_argument('--memory', dest='memory', type=float,
+                        help="Merge on disk within this many megabytes, csv output only.")
+
     if len(sys.argv) == 1:
         join = lambda path: os.path.join(DATA_DIR, path)
         kreport_sample = [join('centrifuge-1.txt'), join('centrifuge-2.txt'), '--is_kreport']
@@ -177,16 +317,33 @@ def main():
 
     args = parser.parse_args()
 
+    if args.memory and args.format != 'csv':
+        print("*** Error: --memory writes csv output only.", file=sys.stderr)
+        sys.exit(1)
+
     if args.is_kreport:
-        # Special case to handle kraken reports
-        df = tabulate(files=args.files, keyidx=args.idx, cutoff=args.cutoff, is_kreport=True)
-        print_kreport(df, outdir=args.outdir, colidx=args.idx, summary=args.summary)
+        keyidx = args.idx
     else:
         assert args.column, "--column or --idx argument required."
         # Map the column name to an index
-        colidx = map_name(name=args.column, files=args.files)
-        df = tabulate(files=args.files, cutoff=args.cutoff, keyidx=colidx)
-        df.to_csv(index=False, path_or_buf=sys.stdout)
+        keyidx = map_name(name=args.column, files=args.files)
+
+    kwargs = dict(files=args.files, keyidx=keyidx, cutoff=args.cutoff, is_kreport=args.is_kreport,
+                  jobs=args.jobs, cachedir=args.cache, skip_zeros=args.skip_zeros)
+
+    if args.memory:
+        # The table is merged and sorted on disk.
+        context = combine_external(budget=args.memory, **kwargs)
+    else:
+        context = nullcontext(combine(**kwargs))
+
+    with context as table:
+        if args.is_kreport:
+            # Special case to handle kraken reports
+            print_kreport(table, outdir=args.outdir, colidx=args.idx, summary=args.summary,
+                          fmt=args.format, compress=args.compress)
+        else:
+            write_table(table, fmt=args.format)
 
 
 
@@ -0,0 +1,150 @@
+"""
+Builds a kraken style report from the per read output of kraken2 or centrifuge.
+
+The reads are counted per taxid in chunks, so memory does not grow with the
+number of reads, then the counts are rolled up the taxonomy of nodes.dmp.
+Centrifuge reads with several hits are counted at the lowest common ancestor
+of the hits.
+"""
+import csv
+import sys
+
+try:
+    from pathlib import Path
+except ImportError:  # in Python 2.7
+    Path = str
+
+try:
+    import plac
+except ImportError as exc:
+    print(f"*** Error: {exc}", file=sys.stderr)
+    print("*** Run: pip install plac", file=sys.stderr)
+    sys.exit(1)
+
+import numpy as np
+import pandas as pd
+
+from src import kreport
+from src.taxonomy import Taxonomy
+
+# Reads processed at a time.
+CHUNK = 1000000
+
+
+def to_taxids(column):
+    """
+    Taxids of a column, kraken2 --use-names writes them as: name (taxid 9606)
+    """
+    try:
+        return column.astype(np.int64).to_numpy()
+    except ValueError:
+        return column.str.extract(r'(\d+)\)?$', expand=False).astype(np.int64).to_numpy()
+
+
+def kraken2_taxids(fname, chunk=CHUNK):
+    """
+    Parses lines such as:
+
+        C	AP012081.1|3|14228-14328	67547	100	67547:66
+
+    Yields the taxids of the reads, unclassified reads have taxid 0.
+    """
+    reader = pd.read_csv(fname, sep="\t", header=None, usecols=[2], dtype=str,
+                         quoting=csv.QUOTE_NONE, chunksize=chunk)
+    for df in reader:
+        yield to_taxids(df[2])
+
+
+def qiime_taxids(fname, chunk=CHUNK):
+    """
+    Parses lines such as:
+
+        Feature ID	Taxid	Taxon	Confidence
+        MG570454|1|13346-13446	186623	Eukaryota;Chordata;Actinopteri	0.9905904770433329
+    """
+    reader = pd.read_csv(fname, sep="\t", usecols=["Taxid"], dtype=str,
+                         quoting=csv.QUOTE_NONE, chunksize=chunk)
+    for df in reader:
+        yield to_taxids(df["Taxid"])
+
+
+def reduce_hits(tree, reads, taxids):
+    """
+    One taxid per read, the lowest common ancestor of the hits of reads that are listed more than once.
+    """
+    taxids = tree.index(taxids)
+    start = np.ones(len(reads), dtype=bool)
+    start[1:] = reads[1:] != reads[:-1]
+    group = np.cumsum(start) - 1
+    pos = np.arange(len(reads)) - np.flatnonzero(start)[group]
+
+    result = taxids[start]
+    for step in range(1, int(pos.max()) + 1 if len(pos) else 0):
+        sel = pos == step
+        result[group[sel]] = tree.lca(result[group[sel]], taxids[sel])
+    return result
+
+
+def centrifuge_taxids(fname, tree, chunk=CHUNK):
+    """
+    Parses lines such as:
+
+        readID	seqID	taxID	score	2ndBestScore	hitLength	queryLength	numMatches
+        AP012081.1|1|15631-15731	AP012081.1	67547	7225	0	100	100	1
+
+    Yields the taxids of the reads, the hits of a read are on consecutive lines.
+    """
+    reader = pd.read_csv(fname, sep="\t", usecols=["readID", "taxID"], dtype={"readID": str, "taxID": np.int64},
+                         quoting=csv.QUOTE_NONE, chunksize=chunk)
+    carry = None
+    for df in reader:
+        if carry is not None:
+            df = pd.concat([carry, df], ignore_index=True)
+
+        reads, taxids = df["readID"].to_numpy(), df["taxID"].to_numpy()
+
+        # The hits of the last read may go on in the next chunk.
+        other = np.flatnonzero(reads != reads[-1])
+        cut = other[-1] + 1 if len(other) else 0
+        carry = df.iloc[cut:]
+
+        yield reduce_hits(tree, reads[:cut], taxids[:cut])
+
+    if carry is not None:
+        yield reduce_hits(tree, carry["readID"].to_numpy(), carry["taxID"].to_numpy())
+
+
+def count_reads(fname, tree):
+    """
+    The number of reads assigned to each taxid.
+    """
+    # Decide if it is kraken2, qiime or centrifuge output
+    header = open(fname).readline()
+
+    if "seqID" in header:
+        chunks = centrifuge_taxids(fname, tree)
+    elif "Feature" in header:
+        chunks = qiime_taxids(fname)
+    else:
+        chunks = kraken2_taxids(fname)
+
+    counts = np.zeros(tree.size, dtype=np.int64)
+    for taxids in chunks:
+        counts += np.bincount(tree.index(taxids), minlength=tree.size)
+    return counts
+
+
+@plac.opt('fname', "classifier output", type=Path)
+@plac.opt('nodes', "the nodes.dmp file", type=Path)
+@plac.opt('names', "the names.dmp file", type=Path, abbrev='m')
+def run(fname, nodes, names):
+
+    tree = Taxonomy.load(str(nodes), names=str(names))
+
+    counts = count_reads(str(fname), tree)
+
+    kreport.write(tree, counts, sys.stdout)
+
+
+if __name__ == '__main__':
+    plac.call(run)
@@ -33,10 +33,9 @@ mkdir -p $TAXDIR
 
 # Uncompress the taxonomy files.
 # (cd $TAXDIR &&  tar -xzvf $TAXDIR/taxdump.tar.gz)
-# (cd $TAXDIR && gunzip nucl_gb.accession2taxid.gz)
 
-# Create the conversion table (accession to taxid mapping).
-# cat $TAXDIR/nucl_gb.accession2taxid | cut -f 2,3 > $TABLE
+# Create the conversion table (accession to taxid mapping) from the compressed file.
+# gzip -dc $TAXDIR/nucl_gb.accession2taxid.gz | cut -f 2,3 > $TABLE
 
 # How many reads to simulate.
 N=1000
@@ -3,7 +3,8 @@ Evaluates a kraken2/centrtifuge report files.
 
 Requires a taxonomy file that identifies the taxonomy id of each accession number.
 """
-import csv, sys, argparse
+import csv, os, sys, argparse
+from multiprocessing import Pool
 from pprint import pprint
 
 try:
@@ -20,6 +21,32 @@ except ImportError as exc:
 
 from collections import defaultdict
 
+import numpy as np
+import pandas as pd
+
+# Reads parsed at a time.
+CHUNK = 1000000
+
+
+def read_chunks(fname, usecols, header='infer'):
+    """
+    Reads the columns of a tab delimited file as strings, in chunks of rows.
+    """
+    return pd.read_csv(fname, sep="\t", header=header, usecols=usecols, dtype=str,
+                       keep_default_na=False, na_filter=False, chunksize=CHUNK)
+
+
+def count_keys(names, taxids, cut, store):
+    """
+    Counts the (name, taxid) pairs after removing the part of the names matched by cut.
+    """
+    names = names.str.replace(cut, '', regex=True)
+    counts = pd.DataFrame({"name": names, "taxid": taxids}).value_counts(sort=False)
+    for key, count in counts.items():
+        store[key] += int(count)
+    return store
+
+
 def parse_qiime_output(fname):
     """
     Parses lines such as:
@@ -33,18 +60,12 @@ def parse_qiime_output(fname):
 
     """
     store = defaultdict(int)
-    stream = open(fname)
-    reader = csv.DictReader(stream, delimiter="\t")
-    for row in reader:
-        name, taxid = row["Feature ID"], row["Taxid"]
-        name = name.split("|")[0]
-        key = (name, taxid)
-        store[key] += 1
-    
+    for df in read_chunks(fname, usecols=["Feature ID", "Taxid"]):
+        # The accession is before the first |
+        count_keys(df["Feature ID"], df["Taxid"], cut=r'\|.*$', store=store)
     return store
 
 
-
 def parse_centrifuge_output(fname):
     """
     Parses lines such as:
@@ -58,13 +79,9 @@ def parse_centrifuge_output(fname):
 
     """
     store = defaultdict(int)
-    stream = open(fname)
-    reader = csv.DictReader(stream, delimiter="\t")
-    for row in reader:
-        name, taxid = row["seqID"], row["taxID"]
-        name = name.split(".")[0]
-        key = (name, taxid)
-        store[key] += 1
+    for df in read_chunks(fname, usecols=["seqID", "taxID"]):
+        # The accession without the version.
+        count_keys(df["seqID"], df["taxID"], cut=r'\..*$', store=store)
     return store
 
 
@@ -79,29 +96,81 @@ def parse_kraken2_output(fname):
         { ("AP012081", 67547): 3994  }
     """
     store = defaultdict(int)
-    stream = open(fname)
-    reader = csv.reader(stream, delimiter="\t")
-    reader = filter(lambda row: row[0] == "C", reader)
-    for row in reader:
-        label, name, taxid = row[:3]
-        name = name.split("|")[0].split(".")[0]
-        key = (name, taxid)
-        store[key] += 1
+    for df in read_chunks(fname, usecols=[0, 1, 2], header=None):
+        # Only the classified reads.
+        df = df[df[0] == "C"]
+        # The accession is before the first | and without the version.
+        count_keys(df[1], df[2], cut=r'[|.].*$', store=store)
     return store
 
 
-def evaluate(tname, lookup, expected):
+def read_truth(tname):
+    """
+    The rows of the file that connects each accession to a taxid and a title.
+    """
+    with open(tname) as stream:
+        return list(csv.reader(stream, delimiter="\t"))
+
+
+# Ranks of the rank resolved accuracy.
+RANKS = "species genus family order class".split()
+
+
+def to_taxids(values):
+    """
+    Taxids as integers, taxids that are not numbers become 0.
+    """
+    return pd.to_numeric(pd.Series(list(values), dtype=str), errors='coerce').fillna(0).to_numpy(np.int64)
+
+
+def rank_counts(rows, lookup, tree, ranks=RANKS):
+    """
+    The reads of each row assigned to the expected taxon at each rank.
+
+    Works on the grouped (expected taxid, assigned taxid, count) pairs of the
+    lookup, the ancestors at each rank are looked up for all pairs at once.
+    """
+    # Each accession gets a slot, the expected taxid is from its first row.
+    index = dict()
+    slots = np.array([index.setdefault(row[0], len(index)) for row in rows], dtype=np.int64)
+    firsts = dict()
+    for row in rows:
+        firsts.setdefault(row[0], row[1])
+    expected = to_taxids(firsts.values())
+
+    pairs = [(index[name], taxid, count) for (name, taxid), count in lookup.items() if name in index]
+    pslots = np.array([pair[0] for pair in pairs], dtype=np.int64)
+    assigned = to_taxids(pair[1] for pair in pairs)
+    counts = np.array([pair[2] for pair in pairs], dtype=np.float64)
+
+    out = np.zeros((len(index), len(ranks)), dtype=np.int64)
+    for col, rank in enumerate(ranks):
+        expect = tree.ancestor_at_rank(expected[pslots], rank)
+        found = tree.ancestor_at_rank(assigned, rank)
+        hit = (expect == found) & (expect != 0)
+        out[:, col] = np.bincount(pslots[hit], weights=counts[hit], minlength=len(index))
+
+    return out[slots]
+
+
+def evaluate(tname, lookup, expected, tree=None):
     """
     Evaluates a taxon file with a lookup relative to expected counts.
+
+    With a taxonomy tree the percent of reads assigned to the expected
+    taxon at each of the RANKS is added.
     """
-    stream = open(tname)
-    reader = csv.reader(stream, delimiter="\t")
+    rows = read_truth(tname)
 
     # Validation table header.
-    header = "accession expect actual percent taxid title".split()
+    header = "accession expect actual percent".split()
+    if tree is not None:
+        header += RANKS
+        ranked = rank_counts(rows, lookup, tree) / expected * 100
+    header += "taxid title".split()
     print("\t".join(header))
 
-    for row in reader:
+    for idx, row in enumerate(rows):
         name, taxid, title = row[:3]
         key = (name, taxid)
         found = int(lookup.get(key, 0))
@@ -111,10 +180,91 @@ def evaluate(tname, lookup, expected):
         row.insert(1, str(expected))
         row.insert(2, str(found))
         row.insert(3, str(perc))
+        if tree is not None:
+            row[4:4] = ["%.1f" % value for value in ranked[idx]]
 
         print("\t".join(row))
 
 
+def parse_output(fname):
+    """
+    Parses a kraken2, centrifuge or qiime output, the format is decided from the first line.
+    """
+    header = open(fname).readline()
+
+    if "seqID" in header:
+        # Centrifuge output has a header
+        return parse_centrifuge_output(fname)
+    elif "Feature" in header:
+        return parse_qiime_output(fname)
+    else:
+        return parse_kraken2_output(fname)
+
+
+# The (accession, taxid) keys of the truth table, set once in each worker.
+KEY_INDEX = None
+
+
+def set_index(index):
+    global KEY_INDEX
+    KEY_INDEX = index
+
+
+def count_vector(fname):
+    """
+    The read counts of an output for each key of the shared key index.
+    """
+    counts = np.zeros(len(KEY_INDEX), dtype=np.int64)
+    for key, count in parse_output(fname).items():
+        idx = KEY_INDEX.get(key)
+        if idx is not None:
+            counts[idx] += count
+    return counts
+
+
+def run_names(fnames):
+    """
+    Column names of the runs, the file names when they are unique.
+    """
+    names = [os.path.basename(str(fname)) for fname in fnames]
+    if len(set(names)) < len(names):
+        names = [str(fname) for fname in fnames]
+    return names
+
+
+def evaluate_batch(tname, fnames, expected, jobs=1):
+    """
+    Evaluates many outputs against one taxon file.
+
+    Prints one row per accession with the percent of the expected reads found by each run.
+    """
+    rows = read_truth(tname)
+
+    # Each distinct key gets a slot in the count vectors.
+    index = dict()
+    slots = np.array([index.setdefault((row[0], row[1]), len(index)) for row in rows], dtype=np.int64)
+
+    fnames = [str(fname) for fname in fnames]
+    if jobs > 1:
+        with Pool(processes=jobs, initializer=set_index, initargs=(index,)) as pool:
+            vectors = pool.map(count_vector, fnames)
+    else:
+        set_index(index)
+        vectors = [count_vector(fname) for fname in fnames]
+
+    # Accessions by runs.
+    counts = np.column_stack(vectors) if vectors else np.zeros((len(index), 0), dtype=np.int64)
+    percent = counts[slots] / expected * 100
+
+    header = "accession expect taxid".split() + run_names(fnames) + ["title"]
+    print("\t".join(header))
+
+    for row, values in zip(rows, percent):
+        name, taxid, title = row[:3]
+        cells = [name, str(expected), taxid] + ["%.1f" % value for value in values] + [title]
+        print("\t".join(cells))
+
+
 #@plac.annotations(
 #    fname=("kraken2/centrifuge output of classified reads", "option", "f", str),
 #    tname=("file to connect each accession to a taxid", "option", "t", str, None, "PATH"),
@@ -124,22 +274,35 @@ def evaluate(tname, lookup, expected):
 @plac.opt('fname', "results file", type=Path)
 @plac.opt('tname', "taxid file", type=Path)
 @plac.opt('count', "expected counts", type=int)
-def run(fname, tname, count=1000):
-
-    # Decide if it is kraken2 or centrifuge output
-    header = open(fname).readline()
-
-    if "seqID" in header:
-        # Centrifuge output has a header
-        lookup = parse_centrifuge_output(fname)
-    elif "Feature" in header:
-        lookup = parse_qiime_output(fname)
-    else:
-        lookup = parse_kraken2_output(fname)
-
-    evaluate(tname, lookup=lookup, expected=count)
+@plac.opt('jobs', "number of processes in batch mode", type=int)
+@plac.opt('nodes', "the nodes.dmp file, adds the percent correct at each rank", type=Path)
+@plac.pos('fnames', "more results files, evaluated together into one table", type=Path)
+def run(fname, tname, count=1000, jobs=1, nodes=None, *fnames):
+
+    # Several result files are evaluated in batch mode.
+    if fnames:
+        if nodes:
+            print("*** Error: the rank columns are computed for a single results file.", file=sys.stderr)
+            sys.exit(1)
+        fnames = ([fname] if fname else []) + list(fnames)
+        evaluate_batch(tname, fnames, expected=count, jobs=jobs)
+        return
+
+    lookup = parse_output(fname)
+
+    tree = None
+    if nodes:
+        # The script is often run on its own, src is only needed for the rank columns.
+        try:
+            from src.taxonomy import Taxonomy
+        except ImportError as exc:
+            print(f"*** Error: {exc}", file=sys.stderr)
+            print("*** Set PYTHONPATH to the root of the repository to use --nodes", file=sys.stderr)
+            sys.exit(1)
+        tree = Taxonomy.load(str(nodes))
+
+    evaluate(tname, lookup=lookup, expected=count, tree=tree)
 
 
 if __name__ == '__main__':
     plac.call(run)
-
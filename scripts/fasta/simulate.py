@@ -8,7 +8,7 @@ Usage:
 The main difference to other tools (and reason for this tool to even exist)
 is it that it generates exactly N reads per each sequence contig.
 """
-import sys, argparse
+import sys
 from random import randint, random, choice
 import itertools
 
@@ -19,18 +19,25 @@ except ImportError as exc:
     print("*** Run: pip install plac", file=sys.stderr)
     sys.exit(1)
 
+try:
+    from src import fasta
+except ImportError:
+    # Run on its own, the file is read sequentially.
+    fasta = None
+
+
+BASES = "ATGC"
+
 
 def strip(x):
     return x.strip()
 
-BASES = "ATGC"
 
 def parse_fasta(stream):
     """
     Returns fasta records.
     Loads the entire fasta record into memory.
     """
-    #stream = open(fname)
     stream = map(strip, stream)
 
     name = desc = seq = ''
@@ -71,7 +78,7 @@ def apply_error(seq, prob=0.1):
 
 
 @plac.annotations(
-    fname=("fasta reference file", "option", "f", argparse.FileType(), None, "PATH"),
+    fname=("fasta reference file", "option", "f", str, None, "PATH"),
     count=("number of reads per accession", "option", "c", int, None, "INT"),
     size=("lenght of each read", "option", "s", int, None, "INT"),
 )
@@ -83,7 +90,8 @@ def run(fname, count=1000, size=100):
     counter = itertools.count(1)
 
 
-    out = parse_fasta(fname)
+    # Reads are sliced from the memory mapped file when src is available.
+    out = fasta.Fasta(fname).records() if fasta else parse_fasta(open(fname))
     for name, desc, seq in out:
 
         for f_start, f_end, f_seq in simulate(seq, count=count, size=size):
@@ -3,17 +3,31 @@ Parses and combines Kraken output files.
 Takes as the input a file that contains filepaths
 to kraken report files.
 """
+import csv
 import os
 import sys
+from array import array
+from contextlib import nullcontext
+from multiprocessing import Pool
 
-import pandas
+import numpy as np
+from src import kreport, outofcore, parse_cache, streams, utils
+from src.abundance import SparseTable
 
+# The columns identifying each row.
+LABELS = ["name", "rank", "tax_id"]
 
-def parse(path, column=0, rank='S'):
+
+def read_report(path, column=0, rank='S', skip_zeros=False):
     """
-    Parses a kraken output into a Pandas dataframe.
+    Reads the rows of a rank (and the unclassified row) from a kraken report.
+
+    Returns a compact tuple that is cheap to send back from a worker process:
+    the file name, the newline joined names and ranks, an array of taxids
+    and an array with the values in the column.
 
-    Since the dataframes are merged later, the column names need to be changed to reflect the sample file name.
+    With skip_zeros the rows without reads are dropped at the byte level,
+    made for reports created with --report-zero-counts.
     """
 
     # Keep only file name component of the path.
@@ -22,84 +36,127 @@ def parse(path, column=0, rank='S'):
     # Drop all extension from filename.
     fname = fname.split(".", 1)[0]
 
-    # The new name of the percent column.
-    col_0 = f'{fname}_percent'
+    names, ranks, taxids, values = [], [], array('q'), array('d')
 
-    # The new name of the clade count column.
-    col_1 = f'{fname}_clade_count'
+    if skip_zeros:
+        # The unclassified row comes first, as in the report.
+        for code, (gnames, gtaxids, gvalues) in kreport.read(path, ranks=[rank]).items():
+            names.extend(gnames)
+            ranks.extend([code] * len(gnames))
+            taxids.extend(gtaxids)
+            values.extend(gvalues[column])
+        return fname, "\n".join(names), "\n".join(ranks), taxids, values
 
-    # The new name of the rank count column.
-    col_2 = f'{fname}_count'
+    for row in csv.reader(open(path, 'rt'), delimiter="\t"):
 
-    # The order of columns in the kraken report file.
-    names = [col_0, col_1, col_2, 'rank', 'tax_id', 'name']
+        # Strip the whitespace from the name column.
+        name = row[5].strip()
 
-    # Read the report file into a dataframe.
-    store = pandas.read_csv(path, sep="\t", names=names)
+        # Keep the species ranks and the unclassified rows.
+        if row[3] != rank and name != 'unclassified':
+            continue
 
-    # Strip the whitespace from the name column.
-    store.name = store.name.str.strip()
+        names.append(name)
+        ranks.append(row[3])
+        taxids.append(int(row[4]))
+        values.append(float(row[column]))
 
-    # Index filter for the species ranks.
-    species_idx = store['rank'] == rank
+    return fname, "\n".join(names), "\n".join(ranks), taxids, values
 
-    # Index filter for unclassified rows.
-    unclass_idx = store['name'] == 'unclassified'
 
-    # Combine the to indices with "or".
-    index = species_idx | unclass_idx
+def load_report(path, column=0, rank='S', cachedir=None, skip_zeros=False):
+    """
+    Reads a kraken report, through the parse cache when a cache directory is set.
+    """
+    if cachedir:
+        return parse_cache.fetch(cachedir, path, read_report, column=column, rank=rank, skip_zeros=skip_zeros)
+    return read_report(path, column=column, rank=rank, skip_zeros=skip_zeros)
 
-    # Slice the dataframe.
-    store = store[index]
 
-    # Rearrange columns for simpler format.
-    cols = store.columns
+def load_report_args(args):
+    return load_report(*args)
 
-    # Name, tax id, value
-    cols = ["name", "rank", "tax_id", cols[column]]
 
-    # Slice the dataframe to contain only the columns of interest.
-    store = store[cols]
+def merge_reports(reports, column=0, skip_zeros=False):
+    """
+    Merges the results of read_report into a sparse table.
+
+    Only the rows found in every report are kept, in the order they are first seen.
+    With skip_zeros a row missing from a report had no reads there, rows found in
+    any report are kept and the missing values are zero.
+    """
+    # The order of columns in the kraken report file.
+    suffix = ["percent", "clade_count", "count"][column]
+    columns = [f'{report[0]}_{suffix}' for report in reports]
 
-    # Return new dataframe.
-    return store
+    parsed = []
+    for fname, names, ranks, taxids, values in reports:
+        keys = list(zip(names.split("\n"), ranks.split("\n"), taxids)) if taxids else []
+        parsed.append((keys, values))
 
+    table = SparseTable.build(parsed, colidx=range(len(reports)), columns=columns)
 
-def merge_frames(frames):
+    # Skipped rows are zeros, the same rows as an outer join of the reports.
+    if skip_zeros:
+        return table
+
+    # Same rows as an inner join of the reports.
+    return table.take(np.flatnonzero(table.present == table.ncols))
+
+
+def merge_external(reports, column=0, budget=outofcore.BUDGET, stream=sys.stdout, skip_zeros=False):
     """
-    Merges and sorts a list of dataframes.
+    Merges and sorts the results of read_report on disk within a memory budget in megabytes.
+
+    Writes the same rows, in the same order, as merge_reports followed by
+    write_sorted, rows with equal means stay in the order they were first seen.
 
-    After merging sorts rows in descending order on mean
-    values across all frames but will keep the unclassified entries as first.
+    The budget covers the buffered entries, the reports parsed ahead by
+    the workers, up to twice as many as processes, are held on top of it.
     """
-    # Take the first element of the collection.
-    out = frames[0]
+    suffix = ["percent", "clade_count", "count"][column]
+    dtype = 'float64' if column == 0 else 'int64'
 
-    # Merge all others into the first.
-    for other in frames[1:]:
-        out = out.merge(other, on=["name", "rank", "tax_id"])
+    with outofcore.ExternalTable(columns=[], budget=budget) as store:
+        # Columns are named as the reports arrive.
+        for col, (fname, names, ranks, taxids, values) in enumerate(reports):
+            store.columns.append(f'{fname}_{suffix}')
+            keys = zip(names.split("\n"), ranks.split("\n"), taxids) if taxids else []
+            store.add(keys, values, col)
 
-    # The columns on which the total should be computed.
-    valid_cols = out.columns[3:]
+        # Only the rows found in every report, unless the zero rows were skipped.
+        # The unclassified entry stays first.
+        ncols = len(store.columns)
+        table = store.select(lambda total, present: skip_zeros or present == ncols, pin_first=True)
+        table.write_csv(stream, names=LABELS, dtype=dtype)
 
-    # The average by row on the valid columns.
-    total = out[valid_cols].mean(axis=1)
 
-    # We always want the unclassified to end up first in the table
-    # so we will pretend that first entry is the highest.
-    total[0] = max(total) + 1
+def write_sorted(table, column=0, fmt='csv'):
+    """
+    Sorts rows in descending order on mean values across all samples
+    but will keep the unclassified entries as first. Ties keep their order.
 
-    # Assign the totals
-    out['total'] = total
+    The table stays sparse until it is written, csv is made dense one block of rows at a time.
+    """
+    # Rows are sorted on their sum, the same order as on their mean. Rows
+    # with equal sums stay in the order they were first seen, as in merge_external.
+    totals = table.totals()
 
-    # Sort the dataframe by totals.
-    out = out.sort_values(by=['total'], ascending=False)
+    # We always want the unclassified to end up first in the table.
+    rest = np.arange(1, table.nrows)
+    order = rest[np.argsort(-totals[1:], kind='stable')]
+    if table.nrows:
+        order = np.concatenate([[0], order])
+    table = table.take(order)
 
-    # Drop the total column.
-    del out['total']
+    # The percent is a float, the counts are integers.
+    dtype = 'float64' if column == 0 else 'int64'
 
     # Print output to standard out
-    out.to_csv(sys.stdout, index=False)
+    if fmt == 'csv':
+        table.write_csv(sys.stdout, names=LABELS, dtype=dtype)
+    else:
+        utils.write_table(table.to_frame(LABELS, dtype=dtype), fmt=fmt)
 
 
 __PROG__ =  os.path.split(__file__)[1]
@@ -125,6 +182,13 @@ def main():
 
     parser.add_argument("--rank", action="store", default="S")
     parser.add_argument("--column", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="Number of processes parsing the reports.")
+    parser.add_argument("--format", default="csv", choices=utils.FORMATS, help="Output format.")
+    parser.add_argument("--cache", help="Directory of parsed reports, unchanged reports are not parsed again.")
+    parser.add_argument("--memory", type=float, help="Merge on disk within this many megabytes, csv output only.")
+    parser.add_argument("--skip_zeros", action="store_true", default=False,
+                        help="Skip the rows without reads, faster on reports made with --report-zero-counts. "
+                             "Taxa without reads in any report are left out.")
     parser.add_argument("paths", nargs='+')
     args = parser.parse_args()
 
@@ -132,9 +196,23 @@ def main():
     rank = args.rank
     column = args.column
 
-    collect = [parse(path, column=column, rank=rank) for path in paths]
+    if args.memory and args.format != 'csv':
+        print("*** Error: --memory writes csv output only.", file=sys.stderr)
+        sys.exit(1)
+
+    tasks = [(path, column, rank, args.cache, args.skip_zeros) for path in paths]
+
+    with Pool(processes=args.jobs) if args.jobs > 1 else nullcontext() as pool:
+        # Workers return compact arrays, the reports are in input order.
+        # Only a few parsed reports may wait while the merge spills to disk.
+        reports = streams.imap(pool, load_report_args, tasks, size=streams.window(args.jobs))
 
-    merge_frames(collect)
+        if args.memory:
+            # Reports are spilled to disk as they arrive.
+            merge_external(reports, column=column, budget=args.memory, skip_zeros=args.skip_zeros)
+        else:
+            table = merge_reports(list(reports), column=column, skip_zeros=args.skip_zeros)
+            write_sorted(table, column=column, fmt=args.format)
 
 
 if __name__ == '__main__':
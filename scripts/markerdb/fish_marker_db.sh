@@ -23,7 +23,7 @@ cat fish_mito_marker_table.txt |cut -f 1 | grep -v "accession"  >fish_mito_marke
 blastdbcmd -db nt -entry_batch fish_mito_marker_acc.txt >fish_mito_markers_nt.fa
 
 # Format fasta file ( duplicated sequences with same headers are written with different headers)
-python remove_nt_redundant_header.py fish_mito_markers_nt.fa >fish_mito_markers.fa
+PYTHONPATH=../.. python remove_nt_redundant_header.py fish_mito_markers_nt.fa >fish_mito_markers.fa
 
 # make blastdb
 makeblastdb -dbtype 'nucl' -parse_seqids -in fish_mito_markers.fa -out fish_mito_markers.fa
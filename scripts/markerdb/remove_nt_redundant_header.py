@@ -4,40 +4,30 @@
 
 import sys, re
 
+from src import fasta
+
 
 def is_header(line):
     return line.startswith(">")
 
 
-def format_seq(seqs):
+def wrap(seq, width=70):
     """
-    Splits a single line sequence into multi-lines.
+    Splits a sequence into lines of width characters.
     """
-    new = dict()
-    for header, seq in seqs.items():
-        # split seq into 70 characters each line
-        seq1 = "\n".join([seq[i:i + 70] for i in range(0, len(seq), 70)])
-        new[header] = seq1
-    return new
+    return "\n".join([seq[i:i + width] for i in range(0, len(seq), width)])
 
 
 def make_fasta_dict(fa):
+    """
+    Maps each header to its sequence, the sequences stay in the memory mapped file.
+    """
     store = dict()
-    header = None
-
-    for line in fa:
-        line = line.strip()
-
-        # Start of fasta header
-        if line.startswith(">"):
-            # Removing the accession version numbers.
-            header = re.sub(r'\.\d+', '', line)
-            store[header] = ""
-        else:
-            # Fasta body.
-            store[header] = store[header] + line
 
-    store = format_seq(store)
+    for name, desc, seq in fa.records():
+        # Removing the accession version numbers.
+        header = re.sub(r'\.\d+', '', ">" + seq.header)
+        store[header] = seq
 
     return store
 
@@ -67,11 +57,12 @@ def write_all_seq(header, seq):
 
 
 if __name__ == "__main__":
-    fasta = sys.argv[1]
-    fa = open(fasta)
+    fa = fasta.Fasta(sys.argv[1])
     store = make_fasta_dict(fa)
 
     for header, seq in store.items():
+        # Only one sequence is read into memory at a time.
+        seq = wrap(str(seq))
         vals = re.split('(>[A-Z])', header)
         vals = [v for v in vals if v != ""]
 
@@ -60,11 +60,12 @@ def run(args):
     prefix = os.path.splitext(os.path.basename(fname))[0]
     prefix = "_".join(prefix.split("_")[:-1])
 
-    counts_file = os.path.join(outdir, prefix + "_counts.csv")
-    percent_file = os.path.join(outdir, prefix + "_perc.csv")
+    ext = utils.extension(args.format)
+    counts_file = os.path.join(outdir, prefix + "_counts" + ext)
+    percent_file = os.path.join(outdir, prefix + "_perc" + ext)
 
-    perc_df.to_csv(percent_file, index=False)
-    counts_df.to_csv(counts_file, index=False)
+    utils.write_table(perc_df, path=percent_file, fmt=args.format)
+    utils.write_table(counts_df, path=counts_file, fmt=args.format)
 
 
 if __name__ == "__main__":
@@ -76,5 +77,7 @@ if __name__ == "__main__":
                         help="Specify the output file.")
     parser.add_argument('--outdir', dest='outdir',
                         help="Specify the output directory .")
+    parser.add_argument('--format', dest='format', default='csv', choices=utils.FORMATS,
+                        help="Specify the output format.")
     args = parser.parse_args()
     run(args)
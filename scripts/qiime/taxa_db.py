@@ -1,9 +1,13 @@
 import sqlite3
 import os, sys
 import csv
+from array import array
 from itertools import *
+from multiprocessing import Pool
 from argparse import ArgumentParser
 
+from src import streams
+
 # set tmp directory for sqlite3
 os.system('mkdir -p ./tmp')
 os.environ["SQLITE_TMPDIR"] = "./tmp"
@@ -11,6 +15,9 @@ os.environ["SQLITE_TMPDIR"] = "./tmp"
 LIMIT = None
 CHUNK = 100000
 
+# Size of the byte ranges parsed by each worker.
+BLOCK = 32 * 1024 * 1024
+
 cols = "taxid taxname species genus family order class phylum kingdom superkingdom"
 fields = cols.split()
 
@@ -38,36 +45,73 @@ def create_db(dbname):
     conn.commit()
 
 
-def create_accession_table(dbname, fname):
-    conn = get_conn(dbname)
-    curs = conn.cursor()
+def byte_ranges(fname, size=BLOCK):
+    """
+    Splits a file into (fname, start, end) byte ranges that end on a newline.
+    """
+    total = os.path.getsize(fname)
+    with open(fname, 'rb') as stream:
+        start = 0
+        while start < total:
+            stream.seek(min(start + size, total))
+            # Move to the end of the current line.
+            stream.readline()
+            end = min(stream.tell(), total)
+            yield fname, start, end
+            start = end
+
+
+def parse_lines(data):
+    """
+    Parses accession2taxid lines into a compact batch:
+    newline joined accessions, newline joined versions and an array of taxids.
+    """
+    accs, versions, taxids = [], [], array('q')
+    for line in data.splitlines():
+        row = line.split(b'\t')
+        # Skip the header and blank lines.
+        if len(row) < 3 or row[0] == b'accession':
+            continue
+        accs.append(row[0].strip())
+        versions.append(row[1].strip())
+        taxids.append(int(row[2]))
 
-    data = []
+    return b'\n'.join(accs), b'\n'.join(versions), taxids
 
-    stream = csv.reader(open(fname), delimiter="\t")
 
-    # stream = islice(stream, LIMIT)
+def parse_range(item):
+    fname, start, end = item
+    with open(fname, 'rb') as stream:
+        stream.seek(start)
+        data = stream.read(end - start)
+    return parse_lines(data)
+
+
+def create_accession_table(dbname, fname, jobs=None):
+    conn = get_conn(dbname)
+    curs = conn.cursor()
 
     def insert_vals(data):
         curs.executemany('INSERT INTO accession VALUES (?,?,?)', data)
         conn.commit()
         print("commit")
 
-    for index, row in enumerate(stream):
-        row = [x.strip() for x in row]
-        acc = row[0]
-        acc_version = row[1]
-        taxid = row[2]
-
-        data.append((acc, acc_version, taxid))
-
-        if len(data) == CHUNK:
-            insert_vals(data)
-            data = []
-
-    # For the remaining
-    if data:
-        insert_vals(data)
+    if streams.is_gzip(fname):
+        # Compressed input can not be split by offset, blocks are read here.
+        blocks = streams.read_blocks(streams.xopen(fname, 'rb'), size=BLOCK)
+        parse = parse_lines
+    else:
+        blocks, parse = byte_ranges(fname), parse_range
+
+    # Workers parse the blocks, the rows are inserted here. Only a few
+    # parsed blocks may wait for the writer at a time.
+    with Pool(processes=jobs) as pool:
+        for accs, versions, taxids in streams.imap(pool, parse, blocks, size=streams.window(jobs)):
+            if not taxids:
+                continue
+            accs = accs.decode().split('\n')
+            versions = versions.decode().split('\n')
+            insert_vals(zip(accs, versions, taxids))
 
     print("Table creation Done")
 
@@ -89,37 +133,30 @@ def create_accession_table(dbname, fname):
 
 
 def create_taxa_table(dbname, fname):
-    # Read lineage dmp file.
-    lineage_map = read_ranked_lineage(fname)
+    # Stream the lineage dmp file.
+    stream = read_ranked_lineage(fname)
 
     conn = get_conn(dbname)
     curs = conn.cursor()
 
-    data = []
-
     def insert(data):
-        curs.executemany('INSERT INTO taxa VALUES (?,?)', data)
+        # The last lineage seen for a taxid is kept.
+        curs.executemany('INSERT OR REPLACE INTO taxa VALUES (?,?)', data)
         conn.commit()
         print("commit")
         return
 
-    for taxid, lineage in lineage_map.items():
-        data.append((taxid, lineage))
-
-        if len(data) == CHUNK:
-            insert(data)
-            data = []
-
-    # For the remaining to be inserted.
-    if data:
+    while True:
+        data = list(islice(stream, CHUNK))
+        if not data:
+            break
         insert(data)
 
     print("Table creation Done")
 
-    # Create index
+    # Create index, the taxid is already indexed as the primary key.
 
     sql_commands = [
-        'CREATE INDEX taxa_taxid ON taxa(taxid)',
         'CREATE INDEX taxa_lineage ON taxa(lineage)',
 
     ]
@@ -133,8 +170,10 @@ def create_taxa_table(dbname, fname):
 
 
 def read_ranked_lineage(fname):
-    ranks = dict()
-    stream = csv.reader(open(fname), delimiter="|")
+    """
+    Yields (taxid, lineage) tuples from a rankedlineage.dmp file.
+    """
+    stream = csv.reader(streams.xopen(fname), delimiter="|")
     # stream = islice(stream, LIMIT)
 
     for row in stream:
@@ -142,28 +181,26 @@ def read_ranked_lineage(fname):
         row.pop()
 
         row = [x.strip() for x in row]
-        taxid = row[0]
+        taxid = int(row[0])
 
-        # Make a ranked dictionary.
-        d = dict(zip(fields, row))
-        taxon = get_ranks(d)
+        taxon = get_ranks(row)
 
         # Remove empty ranks  eg:Eukaryota;Chordata;;;;;Actinopteri
         # Include only non-empty ranks eg: Eukaryota;Chordata;Actinopteri
-        taxon = list(filter(None, taxon.split(";")))
-        taxon = ";".join(taxon)
-        ranks[taxid] = taxon
+        taxon = ";".join(filter(None, taxon))
+        yield taxid, taxon
+
 
-    return ranks
+# Column positions of the ranks in a rankedlineage.dmp row.
+RANK_COLS = [fields.index(name) for name in
+             "superkingdom phylum class order family genus taxname".split()]
 
 
-def get_ranks(ranks):
+def get_ranks(row):
     """
     returns superkingdon, phylum, class, order, family, genus, species
     """
-    out = ";".join([ranks['superkingdom'], ranks['phylum'],
-                    ranks['class'], ranks['order'], ranks['family'],
-                    ranks['genus'], ranks['taxname']])
+    out = [row[idx] for idx in RANK_COLS]
     return out
 
 
@@ -173,9 +210,11 @@ if __name__ == '__main__':
     parser.add_argument('--dbpath', dest='dbpath', required=True,
                         help="Specify the full path of the database destination.")
     parser.add_argument('--accession', dest='acc', required=True,
-                        help="Specify the path to NCBI nucl_gb.accession2taxid file.")
+                        help="Specify the path to NCBI nucl_gb.accession2taxid file (may be gzipped).")
     parser.add_argument('--lineage', dest='lineage', required=True,
                         help="Specify the path to NCBI rankedlineage.dmp file.")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None,
+                        help="Number of processes parsing the accession file (default: all cores).")
 
     args = parser.parse_args()
     dbpath = args.dbpath
@@ -185,5 +224,5 @@ if __name__ == '__main__':
     # dbname = 'taxon_db'
     create_db(dbpath)
     # print_db(dbname)
-    create_accession_table(dbpath, accessions)
+    create_accession_table(dbpath, accessions, jobs=args.jobs)
     create_taxa_table(dbpath, lineages)
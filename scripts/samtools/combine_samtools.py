@@ -2,12 +2,17 @@
 
 This program is used to process idx stats files created by samtools idxstats.
 
+With --bam the same counts are read from the .bai or .csi index of each BAM file.
+
 """
 
 import os
 import sys
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
+from src import bamindex, utils
 
 pd.set_option('display.expand_frame_repr', False)
 pd.options.display.float_format = '{:.1f}'.format
@@ -29,40 +34,92 @@ def plot(data, args):
 ACCESSION, SIZE, MAPPED, UNMAPPED, SUM = ['accession', 'size', 'mapped', 'unmapped', 'sum']
 
 
+def read_idxstats(fname):
+    """
+    Reads an idxstats file with compact column types.
+    """
+    dtype = {ACCESSION: str, SIZE: 'int32', MAPPED: 'int64', UNMAPPED: 'int64'}
+    return pd.read_table(fname, header=None, names=list(dtype), dtype=dtype, keep_default_na=False)
+
+
+def read_bam(fname):
+    """
+    The idxstats of a BAM file read from its .bai or .csi index, without samtools.
+    """
+    df = pd.DataFrame(bamindex.idxstats(fname), columns=[ACCESSION, SIZE, MAPPED, UNMAPPED])
+    return df.astype({SIZE: 'int32', MAPPED: 'int64', UNMAPPED: 'int64'})
+
+
+def pivot(frames, names, join='inner', by_percent=False):
+    """
+    Concatenates the idxstats and pivots the mapped reads into one column per sample.
+
+    Accessions are in the order they are first seen. The inner join keeps
+    the accessions found in every sample, the outer join fills in zeros.
+    """
+    data = pd.concat(frames, ignore_index=True)
+    nsamples = len(frames)
+    sample = np.repeat(np.arange(nsamples), [len(df) for df in frames])
+
+    accession = pd.Categorical(data[ACCESSION], categories=pd.unique(data[ACCESSION]))
+    codes = accession.codes.astype(np.int64)
+    nrows = len(accession.categories)
+
+    mapped = data[MAPPED].to_numpy()
+    if by_percent:
+        # The percent of the mapped reads in each sample, kept as float64 so
+        # that csv rounds as before, the columnar formats store float32.
+        totals = np.bincount(sample, weights=mapped, minlength=nsamples)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mapped = mapped / totals[sample] * 100
+
+    counts = np.zeros((nrows, nsamples), dtype=mapped.dtype)
+    counts[codes, sample] = mapped
+
+    # The size from the first sample with the accession.
+    sizes = np.zeros(nrows, dtype=np.int32)
+    sizes[codes[::-1]] = data[SIZE].to_numpy()[::-1]
+
+    if join == 'inner':
+        cells = np.unique(codes * nsamples + sample)
+        present = np.bincount(cells // nsamples, minlength=nrows)
+        rows = np.flatnonzero(present == nsamples)
+    else:
+        rows = np.arange(nrows)
+
+    res = pd.DataFrame(counts[rows], columns=names)
+    res.insert(0, SIZE, sizes[rows])
+    res.insert(0, ACCESSION, pd.Categorical.from_codes(rows, categories=accession.categories))
+
+    return res
+
+
 def tabulate(args):
     """
     Summarize the index stats.
     """
 
     files = sorted(args.files)
-    colnames = [ACCESSION, SIZE, MAPPED, UNMAPPED]
-    res = None
-    for fname in files:
-        df = pd.read_table(fname, header=None)
-        df.columns = colnames
-        if args.by_percent:
-            values = df[MAPPED]
-            df[MAPPED] = values / values.sum() * 100
-
-        if res is None:
-            res = df[[ACCESSION, SIZE, MAPPED]]
-        else:
-            df = df[[ACCESSION, MAPPED]]
-            res = pd.merge(res, df[[ACCESSION, MAPPED, ]], on=ACCESSION, how='inner')
-
-    # Rename the columns
-    fnames = get_colnames(files)
-
-    colnames = [ACCESSION, SIZE] + fnames
-    res.columns = colnames
-
-    # Sort table by the sum of columns
-    res[SUM] = res[fnames].sum(axis=1)
-    res = res.sort_values(by=SUM, ascending=False)
-    res = res[res[SUM] > args.cutoff]
-
-    # Drop the sum column
-    res = res.drop(SUM, axis=1)
+
+    # The inputs are either idxstats outputs or indexed BAM files.
+    reader = read_bam if args.bam else read_idxstats
+
+    if args.jobs > 1:
+        with Pool(processes=args.jobs) as pool:
+            frames = pool.map(reader, files)
+    else:
+        frames = [reader(fname) for fname in files]
+
+    res = pivot(frames, names=get_colnames(files), join=args.join, by_percent=args.by_percent)
+
+    # Sort table by the sum of columns. Rows with equal sums stay in the
+    # order the accessions are first seen, the unstable sort of the
+    # earlier merge chain left them in no particular order.
+    total = res.iloc[:, 2:].to_numpy().sum(axis=1, dtype=np.float64)
+    order = np.argsort(-total, kind='stable')
+    order = order[total[order] > args.cutoff]
+
+    res = res.iloc[order].reset_index(drop=True)
 
     return res
 
@@ -81,18 +138,33 @@ def main():
                         type=float)
     parser.add_argument('--by_percent', dest='by_percent', default=False, action="store_true",
                         help="Return the percent mapped reads instead of raw mapped reads.")
+    parser.add_argument('--join', dest='join', default='inner', choices=['inner', 'outer'],
+                        help="Keep the accessions found in all files (inner) or in any file (outer) default=%(default)s.")
+    parser.add_argument('--bam', dest='bam', default=False, action="store_true",
+                        help="The files are BAM files, the counts are read from their .bai or .csi index.")
+    parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+                        help="Number of processes reading the files default=%(default)s.")
     parser.add_argument('--show', dest='show', default=False, action="store_true",
                         help="Show the plot in in a GUI window.")
+    parser.add_argument('--format', dest='format', default='csv', choices=utils.FORMATS,
+                        help="Output format default=%(default)s.")
 
     if len(sys.argv) == 1:
         sys.argv.extend(['data/idxstats-1.txt', 'data/idxstats-2.txt', '--by_percent'])
 
     args = parser.parse_args()
 
-    df = tabulate(args)
+    try:
+        df = tabulate(args)
+    except bamindex.BamIndexError as exc:
+        print(f"*** Error: {exc}", file=sys.stderr)
+        sys.exit(1)
 
     # Print the data to screen.
-    print(df.to_csv(index=False, float_format='%.1f'))
+    if args.format == 'csv':
+        print(df.to_csv(index=False, float_format='%.1f'))
+    else:
+        utils.write_table(df, fmt=args.format)
 
     plot(df, args=args)
 
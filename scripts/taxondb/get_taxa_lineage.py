@@ -5,16 +5,39 @@ This program is used to get taxonomy lineage for an accession from 'taxon_db' da
 """
 
 import sys, os
+import socket
 import sqlite3
+from itertools import islice
 from argparse import ArgumentParser
 
+try:
+    from src.lineage_index import normalize
+except ImportError:
+    # Run on its own, without src or numpy, only the SQLite database is used.
+    def normalize(acc):
+        # Remove the version info from the accession the way the loader does.
+        return acc.split(".")[0]
+
+# Lineages are stored once and referenced by id from each accession.
+SQL_LINEAGE = '''SELECT acc2taxon.accession, lineage.lineage FROM acc2taxon
+                 JOIN lineage ON lineage.id = acc2taxon.lineage_id
+                 WHERE acc2taxon.accession IN ({})'''
+
+# Accessions looked up per query, stays below the SQLite parameter limit.
+CHUNK = 900
+
+# How much of the database file to memory map.
+MMAP_SIZE = 2 ** 40
+
 
 def strip(s):
     return s.strip()
 
 
 def get_conn(dbname):
-    conn = sqlite3.connect(dbname)
+    # Read only connection with the database file memory mapped.
+    conn = sqlite3.connect(f"file:{dbname}?mode=ro", uri=True)
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
     return conn
 
 
@@ -24,39 +47,102 @@ def get_cursor(dbname):
     return curs
 
 
-def get_taxa(fname):
+def read_accessions(fname):
+    """
+    Yields the distinct accessions in a file in input order.
+    """
+    seen = set()
+    stream = map(strip, open(fname, "r"))
+    for acc in stream:
+        if not acc or acc in seen:
+            continue
+        seen.add(acc)
+        yield acc
+
+
+def fetch_lineages(curs, accessions):
+    """
+    Returns a dictionary with the lineages found, keyed by the normalized accession.
+    """
+    keys = list(set(map(normalize, accessions)))
+    sql = SQL_LINEAGE.format(",".join("?" * len(keys)))
+    data = dict(curs.execute(sql, keys))
+    return data
+
+
+def connect(path):
+    """
+    Returns a lookup function that queries a running lineage_server.py
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    stream = sock.makefile("rw")
+
+    def fetch(accessions):
+        stream.write("\t".join(["acc"] + accessions))
+        stream.write("\n")
+        stream.flush()
+
+        data = dict()
+        for line in stream:
+            line = line.rstrip("\n")
+            # An empty line ends the reply.
+            if not line:
+                break
+            acc, taxon = line.split("\t", 1)
+            if acc == "error":
+                print(f"*** Error: lineage server: {taxon}", file=sys.stderr)
+                sys.exit(1)
+            if taxon:
+                data[normalize(acc)] = taxon
+        return data
+
+    return fetch
+
+
+def get_taxa(args):
     fname = args.accessions
     outfile = args.outfile
     dbpath = args.dbpath
 
     outfile = open(outfile, "w")
 
-    curs = get_cursor(dbpath)
-
-    data = dict()
-    stream = open(fname, "r")
-    accessions = stream.readlines()
-    accessions = list(map(strip, accessions))
-
-    for acc in accessions:
-
-        curs.execute('SELECT lineage FROM acc2taxon WHERE accession=?', (acc,))
-        res = curs.fetchone()
-        if res is not None:
-            taxon = res[0]
-            data[acc] = taxon
-        else:
-            print("taxonomy id {acc} not found".format(acc=acc))
+    if args.socket:
+        fetch = connect(args.socket)
+    elif os.path.isdir(dbpath):
+        # A memory mapped index built by src/lineage_index.py
+        from src.lineage_index import LineageIndex
+        index = LineageIndex(dbpath)
+        if index.offsets is None:
+            print(f"*** Error: the index stores taxids, not lineages: {dbpath}", file=sys.stderr)
+            sys.exit(1)
+        fetch = index.fetch_lineages
+    else:
+        curs = get_cursor(dbpath)
+        fetch = lambda accessions: fetch_lineages(curs, accessions)
 
     header = "\t".join(["Feature ID", "Taxon"])
     outfile.write(header)
     outfile.write("\n")
-    # print(header)
-    for k, v in data.items():
-        out = "\t".join([k, v])
-        outfile.write(out)
-        outfile.write("\n")
-        # print(out)
+
+    stream = read_accessions(fname)
+
+    while True:
+        accessions = list(islice(stream, CHUNK))
+        if not accessions:
+            break
+
+        data = fetch(accessions)
+
+        # Write the results in the order of the input.
+        for acc in accessions:
+            taxon = data.get(normalize(acc))
+            if taxon is None:
+                print("taxonomy id {acc} not found".format(acc=acc))
+                continue
+            out = "\t".join([acc, taxon])
+            outfile.write(out)
+            outfile.write("\n")
 
     outfile.close()
 
@@ -67,11 +153,13 @@ if __name__ == "__main__":
     parser = ArgumentParser()
 
     parser.add_argument('--dbpath', dest='dbpath',
-                        help="Specify the full path of the lineage database destination.")
+                        help="Specify the full path of the lineage database or index directory.")
     parser.add_argument('--accessions', dest='accessions',
                         help="Text file with accessions")
     parser.add_argument('--outfile', dest='outfile',
                         help="Specify the output file.")
+    parser.add_argument('--socket', dest='socket',
+                        help="Query a running lineage_server.py at this socket instead of --dbpath.")
     args = parser.parse_args()
 
     # fname = sys.argv[1]
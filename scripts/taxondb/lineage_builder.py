@@ -0,0 +1,125 @@
+"""
+
+Creates the lineage.tsv file from the NCBI taxonomy dump and the accession2taxid file.
+
+Each line contains an accession and its ranked lineage:
+
+    AB188190.1<TAB>Eukaryota;Chordata;Actinopteri;Scorpaeniformes;Cottidae;Cottus;Cottus cognatus
+
+Missing ranks are filled with NA. The lineage is computed once per taxid.
+
+"""
+
+import csv
+import sys
+import time
+from argparse import ArgumentParser
+
+from src import streams
+from src.taxonomy import RANKS, Taxonomy
+
+MISSING = "NA"
+
+
+def load_taxonomy(nodes, names):
+    """
+    Returns the parent, the position in RANKS and the scientific name of each taxid as lists indexed by taxid.
+    """
+    tree = Taxonomy.load(nodes, names=names)
+
+    # Ranks that are not reported get -1.
+    codes = [RANKS.index(rank) if rank in RANKS else -1 for rank in tree.rank_names]
+    rank = [codes[code] for code in tree.rank.tolist()]
+
+    return tree.parent.tolist(), rank, tree.names.tolist()
+
+
+class Lineages:
+    """
+    Computes the ranked lineage of taxids, each taxid is resolved only once.
+    """
+
+    def __init__(self, parent, rank, names):
+        self.parent, self.rank, self.names = parent, rank, names
+
+        # Ranked lineage tuples keyed by taxid.
+        self.ranked = {0: (MISSING,) * len(RANKS), 1: (MISSING,) * len(RANKS)}
+
+        # Lineage strings keyed by taxid.
+        self.strings = dict()
+
+    def get_ranked(self, taxid):
+        parent, ranked = self.parent, self.ranked
+
+        # Walk up to the first taxid that is already resolved.
+        path = []
+        node = taxid
+        while node not in ranked:
+            if node >= len(parent) or parent[node] == 0:
+                # Unknown taxid.
+                node = 0
+                break
+            path.append(node)
+            node = parent[node]
+
+        # Resolve the path from the top down.
+        known = ranked[node]
+        for node in reversed(path):
+            code = self.rank[node]
+            if code >= 0:
+                known = known[:code] + (self.names[node] or MISSING,) + known[code + 1:]
+            ranked[node] = known
+
+        return ranked.get(taxid, known)
+
+    def get(self, taxid):
+        value = self.strings.get(taxid)
+        if value is None:
+            value = self.strings[taxid] = ";".join(self.get_ranked(taxid))
+        return value
+
+
+def create_lineage(nodes, names, accessions, outfile):
+    start = time.time()
+
+    parent, rank, names = load_taxonomy(nodes, names)
+    lineages = Lineages(parent=parent, rank=rank, names=names)
+    print(f"Taxonomy loaded: {len(parent)} taxids", file=sys.stderr)
+
+    stream = csv.reader(streams.xopen(accessions), delimiter="\t")
+    out = open(outfile, "w")
+
+    out.write("\t".join(["Feature ID", "Taxon"]))
+    out.write("\n")
+
+    total = 0
+    for row in stream:
+        # Skip the header.
+        if row[0] == "accession":
+            continue
+        acc_version, taxid = row[1], int(row[2])
+        out.write(f"{acc_version}\t{lineages.get(taxid)}\n")
+        total += 1
+
+    out.close()
+
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"Lineage done: {total} accessions, {len(lineages.strings)} taxids in {elapsed:.1f} sec",
+          file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument('--nodes', dest='nodes', required=True,
+                        help="Specify the path to NCBI nodes.dmp file.")
+    parser.add_argument('--names', dest='names', required=True,
+                        help="Specify the path to NCBI names.dmp file.")
+    parser.add_argument('--accession', dest='acc', required=True,
+                        help="Specify the path to NCBI nucl_gb.accession2taxid file (may be gzipped).")
+    parser.add_argument('--outfile', dest='outfile', required=True,
+                        help="Specify the output lineage.tsv file.")
+
+    args = parser.parse_args()
+
+    create_lineage(nodes=args.nodes, names=args.names, accessions=args.acc, outfile=args.outfile)
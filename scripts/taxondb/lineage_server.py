@@ -0,0 +1,197 @@
+"""
+
+Serves taxonomy lineage lookups over a Unix domain socket.
+
+The lineage store is opened once and kept warm between requests.
+Each request is a single tab separated line:
+
+    acc<TAB>AB123.1<TAB>AF125509 ...      accession -> lineage
+    taxid<TAB>9606<TAB>7955 ...           taxid -> lineage (requires --taxadb)
+    stats                                 service counters
+
+The reply has one "key<TAB>lineage" line per key, the lineage is empty when
+not found, and ends with an empty line.
+
+    python lineage_server.py --dbpath lineage_db --socket /tmp/lineage.sock
+
+"""
+
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
+
+import get_taxa_lineage
+
+# Keys looked up per query, stays below the SQLite parameter limit.
+CHUNK = get_taxa_lineage.CHUNK
+
+SQL_TAXA = 'SELECT taxid, lineage FROM taxa WHERE taxid IN ({})'
+
+
+class LRUCache:
+    """
+    Keeps the most recently used lineages.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.data = OrderedDict()
+
+    def get(self, key):
+        value = self.data.get(key)
+        if value is not None:
+            self.data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+
+class LineageService:
+
+    def __init__(self, dbpath, taxadb=None, cache_size=1000000):
+        self.dbpath = dbpath
+        self.taxadb = taxadb
+        self.cache = LRUCache(cache_size)
+        self.stats = dict(clients=0, requests=0, keys=0, hits=0, misses=0, latency=0.0, max_latency=0.0)
+
+        # All store access happens on a single thread.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.executor.submit(self.open).result()
+
+    def open(self):
+        if os.path.isdir(self.dbpath):
+            from src import lineage_index
+            index = lineage_index.LineageIndex(self.dbpath)
+            if index.offsets is None:
+                print(f"*** Error: the index stores taxids, not lineages: {self.dbpath}", file=sys.stderr)
+                sys.exit(1)
+            self.fetch_acc = index.fetch_lineages
+        else:
+            curs = get_taxa_lineage.get_cursor(self.dbpath)
+            self.fetch_acc = lambda keys: get_taxa_lineage.fetch_lineages(curs, keys)
+
+        if self.taxadb:
+            conn = sqlite3.connect(f"file:{self.taxadb}?mode=ro", uri=True)
+            conn.execute(f'PRAGMA mmap_size = {get_taxa_lineage.MMAP_SIZE}')
+            self.taxa_curs = conn.cursor()
+
+    @staticmethod
+    def normalize(kind, key):
+        """
+        The key as stored: accessions without the version, taxids without leading zeros.
+        """
+        if kind == 'acc':
+            return get_taxa_lineage.normalize(key)
+        return str(int(key)) if key.isdigit() else key
+
+    def fetch(self, kind, keys):
+        """
+        Looks up normalized keys in the store, returns the lineages found keyed by them.
+        """
+        data = dict()
+        for start in range(0, len(keys), CHUNK):
+            chunk = keys[start:start + CHUNK]
+            if kind == 'acc':
+                data.update(self.fetch_acc(chunk))
+            else:
+                taxids = [int(key) for key in chunk if key.isdigit()]
+                sql = SQL_TAXA.format(",".join("?" * len(taxids)))
+                data.update((str(taxid), lineage) for taxid, lineage in self.taxa_curs.execute(sql, taxids))
+        return data
+
+    async def lookup(self, kind, keys):
+        """
+        Returns the lineages keyed by the normalized keys, each distinct key is counted once.
+        """
+        keys = list(dict.fromkeys(self.normalize(kind, key) for key in keys))
+
+        data, missing = dict(), []
+        for key in keys:
+            value = self.cache.get((kind, key))
+            if value is None:
+                missing.append(key)
+            else:
+                data[key] = value
+
+        self.stats['hits'] += len(keys) - len(missing)
+        self.stats['misses'] += len(missing)
+
+        if missing:
+            loop = asyncio.get_running_loop()
+            found = await loop.run_in_executor(self.executor, self.fetch, kind, missing)
+            for key, value in found.items():
+                self.cache.put((kind, key), value)
+            data.update(found)
+
+        return data
+
+    async def respond(self, line):
+        fields = line.rstrip("\n").split("\t")
+        kind, keys = fields[0], [key.strip() for key in fields[1:] if key.strip()]
+
+        if kind == 'stats':
+            return [f"{name}\t{value}" for name, value in self.stats.items()]
+
+        if kind == 'taxid' and not self.taxadb:
+            return ["error\ttaxid lookups require --taxadb"]
+
+        if kind not in ('acc', 'taxid'):
+            return [f"error\tunknown request: {kind}"]
+
+        data = await self.lookup(kind, keys)
+        self.stats['keys'] += len(keys)
+        return [f"{key}\t{data.get(self.normalize(kind, key), '')}" for key in keys]
+
+    async def handle(self, reader, writer):
+        self.stats['clients'] += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                start = time.time()
+                lines = await self.respond(line.decode())
+                lines.append("")
+                writer.write("\n".join(lines).encode() + b"\n")
+                await writer.drain()
+
+                elapsed = time.time() - start
+                self.stats['requests'] += 1
+                self.stats['latency'] += elapsed
+                self.stats['max_latency'] = max(self.stats['max_latency'], elapsed)
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        server = await asyncio.start_unix_server(self.handle, path=path, limit=2 ** 24)
+        print(f"Serving {self.dbpath} on {path}", file=sys.stderr)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+
+    parser.add_argument('--dbpath', dest='dbpath', required=True,
+                        help="Specify the full path of the lineage database or index directory.")
+    parser.add_argument('--taxadb', dest='taxadb',
+                        help="Specify the database created by taxa_db.py for taxid lookups.")
+    parser.add_argument('--socket', dest='socket', required=True,
+                        help="Specify the path of the Unix socket.")
+    parser.add_argument('--cache', dest='cache', type=int, default=1000000,
+                        help="How many lineages to keep in the cache default=%(default)s.")
+    args = parser.parse_args()
+
+    service = LineageService(dbpath=args.dbpath, taxadb=args.taxadb, cache_size=args.cache)
+    asyncio.run(service.serve(args.socket))
@@ -10,23 +10,16 @@ CURRENT=$2
 #(cd $TAXDIR && wget ftp://ftp.ncbi.nlm.nih.gov/pub/taxonomy/taxdump.tar.gz)
 #(cd $TAXDIR && wget ftp://ftp.ncbi.nih.gov/pub/taxonomy/accession2taxid/nucl_gb.accession2taxid.gz)
 #(cd $TAXDIR && gunzip taxdump.tar.gz)
-#(cd $TAXDIR && gunzip nucl_gb.accession2taxid.gz)
+# The accession file is read compressed, there is no need to gunzip it.
 
 # Untar file
 #tar -xvf $TAXDIR/taxdump.tar
 
-# Create accession list
-cat $TAXDIR/nucl_gb.accession2taxid |  cut -f 2 | grep -v "accession" >$TAXDIR/accessions.txt
-
-# Run R script in $TAXDIR to create lineage.tsv file
-Rscript $CURRENT/qiime2_lineage.R $TAXDIR/nodes.dmp $TAXDIR/names.dmp $TAXDIR/accessions.txt
-
-# Make the file tab separated with two columns
-sed -i 's/;/\t/' $TAXDIR/lineage.tsv
-# Only for mac.
-#sed -i .bak $'s/;/\t/' $TAXDIR/lineage.tsv
+# Create the tab separated lineage.tsv file, the lineage is computed once per taxid.
+PYTHONPATH=$CURRENT/../.. python $CURRENT/lineage_builder.py --nodes $TAXDIR/nodes.dmp --names $TAXDIR/names.dmp \
+    --accession $TAXDIR/nucl_gb.accession2taxid.gz --outfile $TAXDIR/lineage.tsv
 
 # Create an sqlite database of taxon lineage for faster processing later on.
-python -m recipes.code.lineage_db --dbpath $TAXDIR/lineage_db --infile $TAXDIR/lineage.tsv
+PYTHONPATH=$CURRENT/../.. python $CURRENT/taxon_lineage_db.py --dbpath $TAXDIR/lineage_db --infile $TAXDIR/lineage.tsv
 
 
@@ -1,17 +1,30 @@
 import sqlite3
 import os, sys
 import csv
+import time
 from itertools import *
 from argparse import ArgumentParser
 
+from src import streams
+
 # set tmp directory for sqlite3
 os.system('mkdir -p ./tmp')
 os.environ["SQLITE_TMPDIR"] = "./tmp"
 
-CHUNK = 100000
+CHUNK = 500000
 LIMIT = 100000
 LIMIT = None
 
+# Settings used while bulk loading. The database is rebuilt from scratch
+# on every run so a crash only means starting over.
+BULK_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -1000000',
+]
+
 
 def get_conn(dbname):
     conn = sqlite3.connect(dbname)
@@ -25,50 +38,108 @@ def create_db(dbname):
     conn = get_conn(dbname)
     curs = conn.cursor()
 
-    # create acc2taxon table
+    # create lineage table, one row per distinct lineage.
+    curs.execute('''CREATE TABLE lineage
+               (id INTEGER NOT NULL PRIMARY KEY, lineage TEXT)''')
+
+    # create acc2taxon table, the primary key doubles as the accession index.
     curs.execute('''CREATE TABLE acc2taxon
-               (accession, lineage)''')
+               (accession TEXT NOT NULL PRIMARY KEY,
+                lineage_id INTEGER REFERENCES lineage(id)) WITHOUT ROWID''')
 
     # Save the table within the database (Save changes)
     conn.commit()
 
 
-def create_acc2taxon(dbname, fname):
-    conn = get_conn(dbname)
-    curs = conn.cursor()
-
-    # stream = csv.DictReader(open(fname), delimiter='\t')
-    stream = csv.reader(open(fname), delimiter='\t')
+def read_lineage(fname):
+    """
+    Yields (accession, lineage) tuples from a lineage.tsv file.
+    """
+    stream = csv.reader(streams.xopen(fname), delimiter='\t')
     stream = islice(stream, LIMIT)
-    data = []
-    for index, row in enumerate(stream):
 
-        # data.append((row['Feature ID'], row['Taxon']))
+    for row in stream:
+
+        # Skip the header if present.
+        if row[0] == 'Feature ID':
+            continue
+
         # removing the version info from accession.
         accession = row[0].split(".")[0]
         lineage = row[1]
-        data.append((accession, lineage))
+        yield accession, lineage
 
-        remain = index % CHUNK
 
-        if remain == 0 and data:
-            curs.executemany('INSERT INTO acc2taxon VALUES (?,?)', data)
-            conn.commit()
-            print("commit")
-            print(index)
+def create_acc2taxon(dbname, fname):
+    conn = get_conn(dbname)
+    curs = conn.cursor()
 
-            data = []
-            # print (row['GeneID'])
-    print("Table creation Done")
+    for sql in BULK_PRAGMAS:
+        curs.execute(sql)
 
-    sql_commands = [
-        'CREATE INDEX acc2taxon_accession ON acc2taxon(accession)',
+    start = time.time()
+    stream = read_lineage(fname)
+
+    # Maps each distinct lineage to its id.
+    lineage_ids = dict()
+
+    # Load everything in a single transaction, in large batches.
+    total = inserted = 0
+    curs.execute('BEGIN')
+    while True:
+        chunk = list(islice(stream, CHUNK))
+        if not chunk:
+            break
+
+        # Replace the lineage string with its id, new lineages are stored once.
+        data, lineages = [], []
+        for accession, lineage in chunk:
+            lid = lineage_ids.get(lineage)
+            if lid is None:
+                lid = lineage_ids[lineage] = len(lineage_ids) + 1
+                lineages.append((lid, lineage))
+            data.append((accession, lid))
+
+        curs.executemany('INSERT INTO lineage VALUES (?,?)', lineages)
+        # The first occurrence of an accession is kept.
+        before = conn.total_changes
+        curs.executemany('INSERT OR IGNORE INTO acc2taxon VALUES (?,?)', data)
+        inserted += conn.total_changes - before
+        total += len(data)
+        rate = total / max(time.time() - start, 1e-6)
+        print(f"loaded {total} rows ({rate:.0f} rows/sec)")
+    conn.commit()
 
-    ]
-    for sql in sql_commands:
-        curs.execute(sql)
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"Table creation Done: {total} rows in {elapsed:.1f} sec ({total / elapsed:.0f} rows/sec)")
+    print(f"Distinct lineages: {len(lineage_ids)}")
+
+    # Check the database.
+    check_db(conn, total=total, inserted=inserted)
+
+
+def check_db(conn, total, inserted):
+    """
+    Verifies the integrity and the row count of the finished database.
+
+    total is the number of rows read, inserted the number of rows stored.
+    """
+    curs = conn.cursor()
+
+    status = curs.execute('PRAGMA integrity_check').fetchone()[0]
+    if status != 'ok':
+        print(f"*** Integrity check failed: {status}", file=sys.stderr)
+        sys.exit(1)
+
+    count = curs.execute('SELECT count(*) FROM acc2taxon').fetchone()[0]
+    if count != inserted:
+        print(f"*** Error: inserted {inserted} rows but the table has {count} accessions", file=sys.stderr)
+        sys.exit(1)
+
+    if inserted != total:
+        print(f"*** Warning: {total - inserted} duplicated accessions were skipped", file=sys.stderr)
 
-    print("Indexing done")
+    print(f"Integrity check done: {count} accessions")
 
 
 if __name__ == '__main__':
@@ -77,7 +148,7 @@ if __name__ == '__main__':
     parser.add_argument('--dbpath', dest='dbpath', required=True,
                         help="Specify the full path of the database destination.")
     parser.add_argument('--infile', dest='infile', required=True,
-                        help="Specify the input file required to create the database.")
+                        help="Specify the input file required to create the database (may be gzipped).")
 
     args = parser.parse_args()
     dbpath = args.dbpath
@@ -0,0 +1,184 @@
+"""
+Sparse taxon by sample abundance tables.
+
+Only the cells that have a value are stored, in compressed sparse row
+form, so memory grows with the number of observed (taxon, sample) pairs
+rather than with taxa x samples. The table is made dense one block of
+rows at a time, when it is written out.
+"""
+from array import array
+
+import numpy as np
+import pandas as pd
+
+# Rows made dense at a time when writing.
+CHUNK = 10000
+
+
+class SparseTable:
+
+    def __init__(self, labels, indptr, cols, values, present, columns):
+        """
+        labels  - the key tuple of each row
+        indptr  - row i has its entries in cols[indptr[i]:indptr[i+1]]
+        cols    - the column of each entry, sorted within a row
+        values  - the value of each entry
+        present - how many columns had the row, zero values included
+        columns - the column names
+        """
+        self.labels = labels
+        self.indptr = indptr
+        self.cols = cols
+        self.values = values
+        self.present = present
+        self.columns = list(columns)
+
+    @property
+    def nrows(self):
+        return len(self.labels)
+
+    @property
+    def ncols(self):
+        return len(self.columns)
+
+    @classmethod
+    def build(cls, parsed, colidx, columns, by=None):
+        """
+        Builds a table from (keys, values) pairs parsed from each file.
+
+        colidx is the column of each file. Keys are matched on the element
+        at index "by" when set. The last value seen for a key in a column is
+        kept, as is the last key for a row.
+        """
+        index, labels = dict(), []
+        rows, cols, values = array('q'), array('q'), array('d')
+
+        for (fkeys, fvalues), col in zip(parsed, colidx):
+            for key in fkeys:
+                ident = key if by is None else key[by]
+                rowidx = index.get(ident)
+                if rowidx is None:
+                    rowidx = index[ident] = len(labels)
+                    labels.append(key)
+                else:
+                    labels[rowidx] = key
+                rows.append(rowidx)
+            cols.extend([col] * len(fkeys))
+            values.extend(fvalues)
+
+        rows = np.frombuffer(rows, dtype=np.int64) if rows else np.zeros(0, dtype=np.int64)
+        cols = np.frombuffer(cols, dtype=np.int64) if cols else np.zeros(0, dtype=np.int64)
+        values = np.frombuffer(values, dtype=np.float64) if values else np.zeros(0)
+
+        # Order by row then column, entries of the same cell stay in input order.
+        order = np.lexsort((cols, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+
+        # Keep the last entry of each cell.
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        rows, cols, values = rows[last], cols[last], values[last]
+
+        present = np.bincount(rows, minlength=len(labels))
+
+        # Zero values are not stored.
+        nonzero = values != 0
+        rows, cols, values = rows[nonzero], cols[nonzero], values[nonzero]
+
+        indptr = np.zeros(len(labels) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(labels)), out=indptr[1:])
+
+        return cls(labels=labels, indptr=indptr, cols=cols.astype(np.int32), values=values,
+                   present=present, columns=columns)
+
+    def row_ids(self):
+        return np.repeat(np.arange(self.nrows), np.diff(self.indptr))
+
+    def totals(self):
+        """
+        The sum of each row, adding up the columns in order.
+        """
+        return np.bincount(self.row_ids(), weights=self.values, minlength=self.nrows)
+
+    def take(self, rowidx):
+        """
+        A new table with the rows in rowidx, in that order.
+        """
+        rowidx = np.asarray(rowidx, dtype=np.int64)
+        starts, ends = self.indptr[rowidx], self.indptr[rowidx + 1]
+        sizes = ends - starts
+
+        indptr = np.zeros(len(rowidx) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=indptr[1:])
+
+        # Position of every selected entry.
+        entries = np.repeat(starts - indptr[:-1], sizes) + np.arange(indptr[-1])
+
+        labels = [self.labels[idx] for idx in rowidx]
+        return SparseTable(labels=labels, indptr=indptr, cols=self.cols[entries],
+                           values=self.values[entries], present=self.present[rowidx],
+                           columns=self.columns)
+
+    def partition(self, pos, values):
+        """
+        One table per value of the label element at pos, in a single pass.
+        """
+        groups = dict()
+        for idx, label in enumerate(self.labels):
+            groups.setdefault(label[pos], []).append(idx)
+        return [self.take(groups.get(value, [])) for value in values]
+
+    def select(self, cutoff=0, sort_by=None):
+        """
+        Keeps the rows with totals above the cutoff, sorted by decreasing
+        (label element at sort_by, total). Ties keep their order.
+        """
+        totals = self.totals()
+        keep = np.flatnonzero(totals > cutoff)
+        totals = totals[keep]
+
+        if sort_by is None:
+            order = np.argsort(-totals, kind='stable')
+        else:
+            ranks = np.array([self.labels[idx][sort_by] for idx in keep], dtype=object)
+            codes = np.unique(ranks, return_inverse=True)[1] if len(keep) else ranks
+            order = np.lexsort((-totals, -codes))
+
+        return self.take(keep[order])
+
+    def dense(self, start=0, end=None):
+        """
+        The values of a block of rows as a dense matrix.
+        """
+        end = self.nrows if end is None else end
+        lo, hi = self.indptr[start], self.indptr[end]
+        rows = np.repeat(np.arange(end - start), np.diff(self.indptr[start:end + 1]))
+
+        matrix = np.zeros((end - start, self.ncols))
+        matrix[rows, self.cols[lo:hi]] = self.values[lo:hi]
+        return matrix
+
+    def to_frame(self, names, start=0, end=None, dtype=None):
+        """
+        A dataframe of a block of rows, names are the column names of the labels.
+        """
+        end = self.nrows if end is None else end
+        labels = pd.DataFrame(self.labels[start:end], columns=names)
+        matrix = self.dense(start, end)
+        if dtype is not None:
+            matrix = matrix.astype(dtype)
+        values = pd.DataFrame(matrix, columns=self.columns)
+        return pd.concat([labels, values], axis=1)
+
+    def write_csv(self, stream, names, chunk=CHUNK, dtype=None):
+        """
+        Writes the table as a dense csv, one block of rows at a time.
+        """
+        start = 0
+        while True:
+            end = min(start + chunk, self.nrows)
+            frame = self.to_frame(names, start=start, end=end, dtype=dtype)
+            frame.to_csv(path_or_buf=stream, index=False, header=start == 0)
+            start = end
+            if start >= self.nrows:
+                break
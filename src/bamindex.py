@@ -0,0 +1,163 @@
+"""
+Reads the per reference read counts of a BAM file from its index.
+
+Both .bai and .csi indexes keep a pseudo-bin for each reference that holds
+the number of mapped and unmapped reads placed on it. Together with the
+reference names and lengths from the BAM header this gives the same table
+as samtools idxstats:
+
+    for name, length, mapped, unmapped in idxstats("sample.bam"):
+        ...
+
+BAM and CSI files are BGZF compressed, a series of gzip members that the
+gzip module reads as one stream.
+"""
+import gzip
+import os
+import struct
+
+# The pseudo-bin of the BAI format.
+BAI_PSEUDO_BIN = 37450
+
+
+class BamIndexError(Exception):
+    pass
+
+
+def csi_pseudo_bin(depth):
+    return ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+
+
+def read_exact(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise BamIndexError("unexpected end of file")
+    return data
+
+
+def read_header(fname):
+    """
+    The (name, length) of each reference in the BAM header.
+    """
+    with gzip.open(fname, 'rb') as stream:
+        if read_exact(stream, 4) != b'BAM\x01':
+            raise BamIndexError(f"not a BAM file: {fname}")
+        l_text, = struct.unpack('<i', read_exact(stream, 4))
+        read_exact(stream, l_text)
+        n_ref, = struct.unpack('<i', read_exact(stream, 4))
+        refs = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack('<i', read_exact(stream, 4))
+            name = read_exact(stream, l_name).rstrip(b'\x00').decode()
+            l_ref, = struct.unpack('<i', read_exact(stream, 4))
+            refs.append((name, l_ref))
+    return refs
+
+
+def parse_bins(data, offset, n_bin, pseudo, loffset):
+    """
+    Walks the bins of a reference, returns (mapped, unmapped, offset after the bins).
+
+    Bins of the CSI format carry an extra 8 byte loffset field.
+    """
+    mapped = unmapped = 0
+    extra = 8 if loffset else 0
+    for _ in range(n_bin):
+        bin_id, = struct.unpack_from('<I', data, offset)
+        offset += 4 + extra
+        n_chunk, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        if bin_id == pseudo and n_chunk == 2:
+            # The second chunk holds the read counts.
+            mapped, unmapped = struct.unpack_from('<QQ', data, offset + 16)
+        offset += 16 * n_chunk
+    return mapped, unmapped, offset
+
+
+def no_coor(data, offset):
+    """
+    The optional count of reads without coordinates at the end of the index.
+    """
+    if len(data) >= offset + 8:
+        return struct.unpack_from('<Q', data, offset)[0]
+    return 0
+
+
+def read_bai(fname):
+    """
+    The (mapped, unmapped) counts per reference and the unplaced reads of a .bai index.
+    """
+    with open(fname, 'rb') as stream:
+        data = stream.read()
+
+    if data[:4] != b'BAI\x01':
+        raise BamIndexError(f"not a BAI file: {fname}")
+
+    n_ref, = struct.unpack_from('<i', data, 4)
+    offset = 8
+    counts = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        mapped, unmapped, offset = parse_bins(data, offset + 4, n_bin, BAI_PSEUDO_BIN, loffset=False)
+        # Skip the linear index.
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        counts.append((mapped, unmapped))
+
+    return counts, no_coor(data, offset)
+
+
+def read_csi(fname):
+    """
+    The (mapped, unmapped) counts per reference and the unplaced reads of a .csi index.
+    """
+    with gzip.open(fname, 'rb') as stream:
+        data = stream.read()
+
+    if data[:4] != b'CSI\x01':
+        raise BamIndexError(f"not a CSI file: {fname}")
+
+    min_shift, depth, l_aux = struct.unpack_from('<iii', data, 4)
+    offset = 16 + l_aux
+    n_ref, = struct.unpack_from('<i', data, offset)
+    offset += 4
+    pseudo = csi_pseudo_bin(depth)
+    counts = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from('<i', data, offset)
+        mapped, unmapped, offset = parse_bins(data, offset + 4, n_bin, pseudo, loffset=True)
+        counts.append((mapped, unmapped))
+
+    return counts, no_coor(data, offset)
+
+
+def find_index(fname):
+    """
+    The index next to a BAM file: sample.bam.bai, sample.bai or sample.bam.csi.
+    """
+    root = os.path.splitext(fname)[0]
+    for path in (f"{fname}.bai", f"{root}.bai", f"{fname}.csi", f"{root}.csi"):
+        if os.path.isfile(path):
+            return path
+    raise BamIndexError(f"no .bai or .csi index found for: {fname}")
+
+
+def idxstats(fname, index=None):
+    """
+    The rows of samtools idxstats: (name, length, mapped, unmapped),
+    the last row counts the reads without coordinates.
+    """
+    index = index or find_index(fname)
+    refs = read_header(fname)
+
+    if index.endswith(".csi"):
+        counts, unplaced = read_csi(index)
+    else:
+        counts, unplaced = read_bai(index)
+
+    if len(counts) != len(refs):
+        raise BamIndexError(f"the index has {len(counts)} references, the header has {len(refs)}: {index}")
+
+    rows = [(name, length, mapped, unmapped) for (name, length), (mapped, unmapped) in zip(refs, counts)]
+    rows.append(("*", 0, 0, unplaced))
+    return rows
@@ -0,0 +1,222 @@
+"""
+Indexed access to FASTA files.
+
+The file is memory mapped and described by a samtools compatible .fai
+index, built next to the file when missing or older than the file:
+
+    fasta = Fasta("reference.fa")
+
+    for name, desc, seq in fasta.records():
+        print(name, len(seq), seq[0:10])
+
+    fasta.fetch("NC_012920", 100, 200)
+
+Sequences are read straight from the mapped file. A slice inside a single
+line is a zero copy memoryview, longer slices are joined with the line
+breaks removed, only the slice is ever copied.
+"""
+import mmap
+import os
+
+from src import streams
+
+
+class FastaError(Exception):
+    pass
+
+
+def build_index(data):
+    """
+    The (name, length, offset, linebases, linewidth) of each sequence in the mapped file.
+    """
+    entries = []
+    size = len(data)
+    if data[:1] == b'>':
+        start = 0
+    else:
+        start = data.find(b'\n>')
+        start = start + 1 if start != -1 else -1
+
+    while start != -1:
+        eol = data.find(b'\n', start)
+        eol = size if eol == -1 else eol
+        header = data[start + 1:eol].strip()
+        name = header.split(maxsplit=1)[0].decode() if header else ''
+
+        # The sequence ends where the next header starts.
+        seqstart = min(eol + 1, size)
+        nxt = data.find(b'\n>', eol)
+        end = nxt + 1 if nxt != -1 else size
+
+        region = data[seqstart:end]
+        length = len(region) - region.count(b'\n') - region.count(b'\r')
+
+        first = region.find(b'\n')
+        if first == -1:
+            linebases = linewidth = len(region)
+        else:
+            linewidth = first + 1
+            linebases = first - 1 if region[first - 1:first] == b'\r' else first
+
+        # All lines but the last must have the same width.
+        full = (length - 1) // linebases if linebases else 0
+        if full and region[linewidth - 1:full * linewidth:linewidth] != b"\n" * full:
+            raise FastaError(f"different line lengths in sequence: {name}")
+
+        entries.append((name, length, seqstart, linebases, linewidth))
+        start = nxt + 1 if nxt != -1 else -1
+
+    return entries
+
+
+def read_index(fname):
+    entries = []
+    with open(fname, 'rt') as stream:
+        for line in stream:
+            name, length, offset, linebases, linewidth = line.rstrip("\n").split("\t")[:5]
+            entries.append((name, int(length), int(offset), int(linebases), int(linewidth)))
+    return entries
+
+
+def write_index(fname, entries):
+    with open(fname, 'wt') as stream:
+        for entry in entries:
+            stream.write("\t".join(map(str, entry)) + "\n")
+
+
+class Sequence:
+    """
+    A sequence of a FASTA file, slicing returns strings.
+    """
+
+    def __init__(self, fasta, idx):
+        self.fasta = fasta
+        self.idx = idx
+        self.name, self.length = fasta.entries[idx][:2]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(self.length)
+            if step != 1:
+                raise ValueError("slices with steps are not supported")
+            return bytes(self.fasta.fetch(self.idx, start, end)).decode()
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("sequence index out of range")
+        return bytes(self.fasta.fetch(self.idx, key, key + 1)).decode()
+
+    def __str__(self):
+        return self[:]
+
+    @property
+    def header(self):
+        """
+        The header line without the leading >.
+        """
+        return self.fasta.header(self.idx)
+
+
+class Fasta:
+
+    def __init__(self, fname, index=None):
+        """
+        Opens a FASTA file and its .fai index, the index is built when missing or stale.
+        """
+        self.fname = fname
+        if streams.is_gzip(fname):
+            raise FastaError(f"compressed FASTA files are not supported: {fname}")
+
+        self.stream = open(fname, 'rb')
+        try:
+            self.data = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped.
+            self.data = b''
+
+        index = index or f"{fname}.fai"
+        if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(fname):
+            self.entries = read_index(index)
+        else:
+            self.entries = build_index(self.data)
+            try:
+                write_index(index, self.entries)
+            except OSError:
+                # The index is kept in memory when the folder is read only.
+                pass
+
+        # Duplicated names point to their first sequence.
+        self.lookup = dict()
+        for idx, entry in enumerate(self.entries):
+            self.lookup.setdefault(entry[0], idx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.stream.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def __getitem__(self, name):
+        return Sequence(self, self.lookup[name])
+
+    @property
+    def names(self):
+        return [entry[0] for entry in self.entries]
+
+    def position(self, idx):
+        return idx if isinstance(idx, int) else self.lookup[idx]
+
+    def header(self, idx):
+        """
+        The header line of a sequence, found right before its first base.
+        """
+        offset = self.entries[self.position(idx)][2]
+        end = offset - 1 if self.data[offset - 1:offset] == b'\n' else offset
+        start = self.data.rfind(b'\n', 0, end) + 1
+        return self.data[start + 1:end].strip().decode()
+
+    def fetch(self, idx, start=0, end=None):
+        """
+        The bases start to end of a sequence given by name or position.
+
+        A memoryview into the file when the bases are on one line, bytes otherwise.
+        """
+        name, length, offset, linebases, linewidth = self.entries[self.position(idx)]
+        end = length if end is None else min(end, length)
+        start = max(0, min(start, end))
+        if start == end:
+            return memoryview(b'')
+
+        first, col = divmod(start, linebases)
+        last, lcol = divmod(end - 1, linebases)
+        lo = offset + first * linewidth + col
+        hi = offset + last * linewidth + lcol + 1
+
+        if first == last:
+            return memoryview(self.data)[lo:hi]
+
+        return self.data[lo:hi].translate(None, b'\r\n')
+
+    def records(self):
+        """
+        Generates (name, description, sequence) in file order.
+        """
+        for idx in range(len(self.entries)):
+            seq = Sequence(self, idx)
+            elems = seq.header.split(maxsplit=1)
+            desc = elems[1] if len(elems) == 2 else ''
+            yield seq.name, desc, seq
@@ -0,0 +1,142 @@
+"""
+Fast reader for kraken style reports.
+
+Reports made with --report-zero-counts have a line for every node of the
+taxonomy, nearly all of them with zero reads. The lines with reads are
+found with a regular expression over the raw bytes, so zero count lines
+are skipped before any field is split and the work grows with the number
+of observed taxa. All ranks are collected in a single pass:
+
+    groups = kreport.read("sample.kreport.txt")
+    names, taxids, values = groups["S"]
+
+values holds the percent, clade count and count columns.
+
+Reports are also built from the number of reads assigned to each taxid,
+with the clade counts rolled up a Taxonomy tree:
+
+    write(tree, counts, sys.stdout)
+"""
+import mmap
+import re
+from array import array
+
+import numpy as np
+
+# Lines with a non zero clade count, and the unclassified line even when zero.
+LINE = re.compile(rb'^[^\t\n]*\t(?:(?!0\t)|0\t[^\t\n]*\tU\t)[^\n]*', re.M)
+
+# Rank code of the unclassified line.
+UNCLASSIFIED = 'U'
+
+# Rank codes of the ranks shown in reports, other ranks are numbered below them.
+RANK_CODES = {
+    'superkingdom': 'D', 'kingdom': 'K', 'phylum': 'P', 'class': 'C',
+    'order': 'O', 'family': 'F', 'genus': 'G', 'species': 'S',
+}
+
+
+def mapped(fname):
+    """
+    The contents of a file, memory mapped when not empty.
+    """
+    with open(fname, 'rb') as stream:
+        try:
+            return mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return b''
+
+
+def read(fname, ranks=None):
+    """
+    Groups the lines with reads by rank code, in the order the ranks first appear.
+
+    Only the ranks in ranks are kept when set, the unclassified line is always kept.
+    Each group is (names, taxids, values) where values are the three count columns.
+    """
+    groups = dict()
+    for match in LINE.finditer(mapped(fname)):
+        fields = match.group().rstrip(b'\r').split(b'\t')
+        rank = fields[3].decode()
+        if ranks and rank not in ranks and rank != UNCLASSIFIED:
+            continue
+        group = groups.get(rank)
+        if group is None:
+            group = groups[rank] = ([], array('q'), (array('d'), array('d'), array('d')))
+        names, taxids, values = group
+        names.append(fields[5].strip().decode())
+        taxids.append(int(fields[4]))
+        for col in range(3):
+            values[col].append(float(fields[col]))
+    return groups
+
+
+def clade_counts(tree, counts):
+    """
+    Adds the reads of each taxid to all of its ancestors, one level at a time from the deepest.
+
+    Reads of taxids missing from the tree are counted as unclassified.
+    """
+    clade = np.asarray(counts, dtype=np.int64).copy()
+
+    missing = (tree.parent == 0) & (clade > 0)
+    missing[0] = False
+    clade[0] += clade[missing].sum()
+    clade[missing] = 0
+
+    order = np.argsort(tree.depth, kind='stable')
+    bounds = np.searchsorted(tree.depth[order], np.arange(tree.depth.max() + 2))
+    for level in range(int(tree.depth.max()), 0, -1):
+        nodes = order[bounds[level]:bounds[level + 1]]
+        nodes = nodes[clade[nodes] > 0]
+        np.add.at(clade, tree.parent[nodes], clade[nodes])
+
+    return clade
+
+
+def write(tree, counts, stream):
+    """
+    Writes the six column report of the reads counted at each taxid.
+
+    Taxa are listed depth first, children by decreasing clade count, taxa without reads are left out.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    clade = clade_counts(tree, counts)
+    direct = counts.copy()
+    direct[0] = clade[0]
+    total = max(int(counts.sum()), 1)
+
+    def line(taxid, code, name, indent):
+        percent = clade[taxid] / total * 100
+        stream.write(f"{percent:6.2f}\t{clade[taxid]}\t{direct[taxid]}\t{code}\t{taxid}\t{'  ' * indent}{name}\n")
+
+    if clade[0]:
+        line(0, UNCLASSIFIED, 'unclassified', 0)
+
+    # The observed taxa grouped by parent, by decreasing clade count within a parent.
+    nodes = np.flatnonzero(clade > 0)
+    nodes = nodes[nodes != 0]
+    nodes = nodes[np.lexsort((nodes, -clade[nodes], tree.parent[nodes]))]
+
+    children = dict()
+    roots = []
+    for node, parent in zip(nodes.tolist(), tree.parent[nodes].tolist()):
+        if node == parent:
+            roots.append(node)
+        else:
+            children.setdefault(parent, []).append(node)
+
+    # Depth first, the stack holds (taxid, indent, code of the closest shown rank, levels below it).
+    stack = [(root, 0, 'R', 0) for root in reversed(roots)]
+    while stack:
+        node, indent, base, below = stack.pop()
+        rank = tree.rank_names[tree.rank[node]]
+        if indent and rank in RANK_CODES:
+            base, below = RANK_CODES[rank], 0
+        elif indent:
+            below += 1
+        code = f"{base}{below}" if below else base
+        name = tree.names[node] if tree.names is not None else str(node)
+        line(node, code, name, indent)
+        for child in reversed(children.get(node, [])):
+            stack.append((child, indent + 1, base, below))
@@ -0,0 +1,199 @@
+"""
+Read only accession index stored as sorted fixed width keys.
+
+The index is a directory with:
+
+    keys.npy     - sorted accessions (version removed), fixed width bytes
+    values.npy   - the lineage id or the taxid for each key
+    lineages.txt - the distinct lineages, one per line (lineage indices only)
+    offsets.npy  - start of each lineage in lineages.txt
+
+All files are memory mapped so concurrent jobs share the operating system page cache.
+
+Build it from a lineage.tsv or a nucl_gb.accession2taxid file, plain or gzipped:
+
+    python -m src.lineage_index --infile lineage.tsv --dbpath lineage_index
+"""
+import csv
+import os
+import time
+from itertools import islice
+
+import numpy as np
+
+from src import streams
+
+CHUNK = 1000000
+
+KEYS, VALUES, LINEAGES, OFFSETS = 'keys.npy', 'values.npy', 'lineages.txt', 'offsets.npy'
+
+
+def normalize(acc):
+    # Remove the version info from the accession.
+    return acc.split(".")[0]
+
+
+def read_rows(fname):
+    """
+    Yields (accession, value) rows and reports whether the values are taxids.
+    """
+    stream = csv.reader(streams.xopen(fname), delimiter='\t')
+    header = next(stream, None)
+
+    # The accession2taxid file has a header with four columns.
+    is_taxid = header is not None and header[0] == 'accession'
+
+    def rows():
+        if header is not None and header[0] not in ('accession', 'Feature ID'):
+            yield header
+        for row in stream:
+            yield row
+
+    if is_taxid:
+        data = ((row[0], int(row[2])) for row in rows())
+    else:
+        data = ((normalize(row[0]), row[1]) for row in rows())
+
+    return is_taxid, data
+
+
+def build(fname, dbpath):
+    """
+    Builds the index at dbpath from a lineage.tsv or accession2taxid file.
+    """
+    start = time.time()
+    is_taxid, stream = read_rows(fname)
+
+    # Maps each distinct lineage to its id.
+    lineage_ids = dict()
+
+    key_chunks, value_chunks = [], []
+    total = 0
+    while True:
+        chunk = list(islice(stream, CHUNK))
+        if not chunk:
+            break
+
+        accs, values = zip(*chunk)
+        if not is_taxid:
+            values = [lineage_ids.setdefault(lineage, len(lineage_ids)) for lineage in values]
+
+        key_chunks.append(np.array([acc.encode() for acc in accs], dtype='S'))
+        value_chunks.append(np.array(values, dtype=np.uint32))
+
+        total += len(chunk)
+        print(f"read {total} rows")
+
+    keys = np.concatenate(key_chunks) if key_chunks else np.array([], dtype='S1')
+    values = np.concatenate(value_chunks) if value_chunks else np.array([], dtype=np.uint32)
+
+    # Sort on the keys, the first occurrence of an accession is kept.
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    keys, values = keys[first], values[first]
+
+    os.makedirs(dbpath, exist_ok=True)
+    np.save(os.path.join(dbpath, KEYS), keys)
+    np.save(os.path.join(dbpath, VALUES), values)
+
+    if not is_taxid:
+        # Lineages are written in id order.
+        lineages = [lineage.encode() for lineage in lineage_ids]
+        sizes = np.array([len(lineage) + 1 for lineage in lineages], dtype=np.uint64)
+        offsets = np.zeros(len(lineages) + 1, dtype=np.uint64)
+        np.cumsum(sizes, out=offsets[1:])
+        with open(os.path.join(dbpath, LINEAGES), 'wb') as stream:
+            for lineage in lineages:
+                stream.write(lineage + b'\n')
+        np.save(os.path.join(dbpath, OFFSETS), offsets)
+
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"Index done: {len(keys)} accessions in {elapsed:.1f} sec ({total / elapsed:.0f} rows/sec)")
+
+
+class LineageIndex:
+    """
+    Batch lookups over an index created by build().
+    """
+
+    def __init__(self, dbpath):
+        load = lambda name: np.load(os.path.join(dbpath, name), mmap_mode='r')
+        self.keys = load(KEYS)
+        self.values = load(VALUES)
+
+        path = os.path.join(dbpath, LINEAGES)
+        if os.path.isfile(path):
+            self.offsets = load(OFFSETS)
+            self.lineages = np.memmap(path, dtype=np.uint8, mode='r') if os.path.getsize(path) else b''
+        else:
+            self.offsets = self.lineages = None
+
+    def search(self, accessions):
+        """
+        Returns the position of each accession in the index, -1 when missing.
+        """
+        query = np.array([normalize(acc).encode() for acc in accessions], dtype='S')
+        if not len(query) or not len(self.keys):
+            return np.full(len(query), -1, dtype=np.int64)
+
+        # Queries wider than the keys can not be in the index.
+        width = self.keys.dtype.itemsize
+        fits = np.char.str_len(query) <= width
+        query = query.astype(self.keys.dtype)
+
+        # Sorted queries walk the keys in order.
+        order = np.argsort(query)
+        idx = np.empty(len(query), dtype=np.int64)
+        idx[order] = np.searchsorted(self.keys, query[order])
+        idx = np.minimum(idx, len(self.keys) - 1)
+
+        found = fits & (self.keys[idx] == query)
+        return np.where(found, idx, -1)
+
+    def fetch_taxids(self, accessions):
+        """
+        Returns a dictionary of taxids keyed by the normalized accession.
+        """
+        idx = self.search(accessions)
+        found = np.flatnonzero(idx >= 0)
+        values = self.values[idx[found]]
+        data = {normalize(accessions[pos]): int(value) for pos, value in zip(found, values)}
+        return data
+
+    def fetch_lineages(self, accessions):
+        """
+        Returns a dictionary of lineages keyed by the normalized accession.
+        """
+        if self.offsets is None:
+            raise ValueError("The index stores taxids, not lineages.")
+
+        idx = self.search(accessions)
+        found = np.flatnonzero(idx >= 0)
+        lids = self.values[idx[found]].astype(np.int64)
+        starts, ends = self.offsets[lids], self.offsets[lids + 1] - 1
+
+        data = dict()
+        for pos, start, end in zip(found, starts, ends):
+            data[normalize(accessions[pos])] = bytes(self.lineages[start:end]).decode()
+        return data
+
+
+def main():
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+
+    parser.add_argument('--dbpath', dest='dbpath', required=True,
+                        help="Specify the directory of the index.")
+    parser.add_argument('--infile', dest='infile', required=True,
+                        help="Specify the lineage.tsv or nucl_gb.accession2taxid file (may be gzipped).")
+
+    args = parser.parse_args()
+
+    build(fname=args.infile, dbpath=args.dbpath)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+"""
+Out of core combine of abundance tables.
+
+The parsed reports are buffered up to a memory budget, then sorted on
+their key and spilled to run files in a temporary folder. The runs are
+merged with a k-way merge so that all cells of a key arrive together.
+Rows that pass the filter are spilled again, bucketed by a label element
+and sorted by decreasing total, then streamed out one block at a time:
+
+    with ExternalTable(columns, by=1, budget=512) as store:
+        for col, (keys, values) in enumerate(parsed):
+            store.add(keys, values, col)
+        table = store.select(lambda total, present: total > 0, sort_by=2)
+        table.write_csv(sys.stdout, names=["name", "taxid", "rank"])
+
+The rows come out in the same order as with SparseTable.select().
+"""
+import heapq
+import itertools
+import os
+import shutil
+import tempfile
+
+from src.abundance import CHUNK, SparseTable
+
+# Approximate bytes held in memory by a buffered entry.
+ENTRY_SIZE = 256
+
+# Default memory budget in megabytes.
+BUDGET = 1024
+
+# Separates the elements of a key in the run files.
+SEP = "\x1f"
+
+
+def read_entries(path):
+    """
+    Entries of a run: (ident, fileidx, pos, col, value, key).
+    """
+    with open(path, 'rt') as stream:
+        for line in stream:
+            fields = line.rstrip("\n").split("\t")
+            yield (fields[0], int(fields[1]), int(fields[2]),
+                   int(fields[3]), float(fields[4]), tuple(fields[5:]))
+
+
+def read_rows(path):
+    """
+    Rows of a run: (order, key, cells).
+    """
+    with open(path, 'rt') as stream:
+        for line in stream:
+            fields = line.rstrip("\n").split("\t")
+            order = (-float(fields[0]), int(fields[1]), int(fields[2]))
+            cells = [cell.split(":") for cell in fields[3].split(";") if cell]
+            cells = [(int(col), float(value)) for col, value in cells]
+            yield order, tuple(fields[4:]), cells
+
+
+class Rows:
+    """
+    Rows of (key, cells) pairs that are written out in blocks.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __iter__(self):
+        return iter(())
+
+    def blocks(self, chunk=CHUNK):
+        """
+        The rows as sparse tables of up to chunk rows.
+        """
+        rows = iter(self)
+        while True:
+            block = list(itertools.islice(rows, chunk))
+            if not block:
+                return
+            labels, cols, values, indptr = [], [], [], [0]
+            for key, cells in block:
+                labels.append(key)
+                cols.extend(col for col, value in cells)
+                values.extend(value for col, value in cells)
+                indptr.append(len(cols))
+            yield SparseTable(labels=labels, indptr=indptr, cols=cols, values=values,
+                              present=None, columns=self.columns)
+
+    def write_csv(self, stream, names, chunk=CHUNK, dtype=None):
+        """
+        Writes the rows as a dense csv, one block of rows at a time.
+        """
+        empty = SparseTable(labels=[], indptr=[0], cols=[], values=[], present=None, columns=self.columns)
+        header = True
+        for block in itertools.chain(self.blocks(chunk=chunk), [empty]):
+            if block.nrows or header:
+                frame = block.to_frame(names, dtype=dtype)
+                frame.to_csv(path_or_buf=stream, index=False, header=header)
+            header = False
+
+
+class SortedRows(Rows):
+    """
+    Rows merged from sorted runs each time they are read.
+    """
+
+    def __init__(self, columns, runs=(), rows=()):
+        """
+        runs are run files and rows an in memory list, both sorted on order.
+        """
+        super().__init__(columns)
+        self.runs = list(runs)
+        self.rows = list(rows)
+
+    def __iter__(self):
+        sources = [read_rows(path) for path in self.runs] + [iter(self.rows)]
+        for order, key, cells in heapq.merge(*sources, key=lambda row: row[0]):
+            yield key, cells
+
+
+class Selection(Rows):
+    """
+    The selected rows of an external table, bucketed by a label element.
+    """
+
+    def __init__(self, columns, buckets, sort_by=None, head=None):
+        super().__init__(columns)
+        self.buckets = buckets
+        self.sort_by = sort_by
+        self.head = head
+
+    def partition(self, pos, values):
+        """
+        One set of rows per value of the label element at pos.
+        """
+        if pos != self.sort_by:
+            raise ValueError(f"rows are bucketed on the label element {self.sort_by}")
+        return [self.buckets.get(value, SortedRows(self.columns)) for value in values]
+
+    def __iter__(self):
+        if self.head:
+            yield self.head
+        # Buckets in decreasing order of their label element.
+        for value in sorted(self.buckets, reverse=True):
+            yield from self.buckets[value]
+
+
+class ExternalTable:
+    """
+    Collects (key, value) entries by column and merges them on disk.
+    """
+
+    def __init__(self, columns, by=None, budget=BUDGET, tmpdir=None):
+        """
+        by     - keys are matched on the element at this index, on the whole key when None
+        budget - memory budget in megabytes
+        """
+        self.columns = list(columns)
+        self.by = by
+        self.limit = max(1, int(budget * 1024 * 1024) // ENTRY_SIZE)
+        self.folder = tempfile.mkdtemp(prefix="combine-", dir=tmpdir)
+        self.runs = []
+        self.buffer = []
+        self.fileidx = 0
+        self.counter = itertools.count()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, f"{name}-{next(self.counter)}.txt")
+
+    def ident(self, key):
+        return SEP.join(key) if self.by is None else key[self.by]
+
+    def add(self, keys, values, col):
+        """
+        Adds the parsed keys and values of a file to a column.
+        """
+        fileidx = self.fileidx
+        self.fileidx += 1
+        for pos, (key, value) in enumerate(zip(keys, values)):
+            key = tuple(map(str, key))
+            self.buffer.append((self.ident(key), fileidx, pos, col, value, key))
+            if len(self.buffer) >= self.limit:
+                self.spill()
+
+    def spill(self):
+        """
+        Sorts the buffer and writes it to a run file.
+        """
+        self.buffer.sort(key=lambda entry: entry[:3])
+        path = self.path("entries")
+        with open(path, 'wt') as stream:
+            for ident, fileidx, pos, col, value, key in self.buffer:
+                stream.write(f"{ident}\t{fileidx}\t{pos}\t{col}\t{value!r}\t" + "\t".join(key) + "\n")
+        self.runs.append(path)
+        self.buffer = []
+
+    def merged(self):
+        """
+        Merges the runs, yields (first, key, cells) for each key.
+
+        first is where the key was seen first, key is the last one seen and
+        cells the (column, value) pairs sorted by column, the last value
+        seen for a column wins.
+        """
+        self.buffer.sort(key=lambda entry: entry[:3])
+        sources = [read_entries(path) for path in self.runs] + [iter(self.buffer)]
+        entries = heapq.merge(*sources, key=lambda entry: entry[:3])
+
+        for ident, group in itertools.groupby(entries, key=lambda entry: entry[0]):
+            group = list(group)
+            first = group[0][1:3]
+            cells = dict()
+            for entry in group:
+                cells[entry[3]] = entry[4]
+            yield first, group[-1][5], sorted(cells.items())
+
+        self.buffer = []
+
+    def select(self, keep, sort_by=None, pin_first=False):
+        """
+        Keeps the rows where keep(total, present) is true, sorted by
+        decreasing (label element at sort_by, total). Ties keep the order in
+        which the keys were first seen.
+
+        With pin_first the row of the key seen first goes before all others.
+        """
+        buckets, runs, head = dict(), dict(), None
+        count = 0
+
+        def dump():
+            for value, rows in buckets.items():
+                rows.sort(key=lambda row: row[0])
+                path = self.path("rows")
+                with open(path, 'wt') as stream:
+                    for (order, fileidx, pos), key, cells in rows:
+                        cells = ";".join(f"{col}:{val!r}" for col, val in cells)
+                        stream.write(f"{-order!r}\t{fileidx}\t{pos}\t{cells}\t" + "\t".join(key) + "\n")
+                runs.setdefault(value, []).append(path)
+            buckets.clear()
+
+        for first, key, cells in self.merged():
+            # Columns are added in order, as in SparseTable.totals().
+            total = 0.0
+            for col, value in cells:
+                if value != 0:
+                    total += value
+            if not keep(total, len(cells)):
+                continue
+
+            # Zero values are not stored.
+            cells = [(col, value) for col, value in cells if value != 0]
+            row = ((-total,) + first, key, cells)
+
+            if pin_first and (head is None or row[0][1:] < head[0][1:]):
+                row, head = head, row
+                if row is None:
+                    continue
+
+            value = None if sort_by is None else key[sort_by]
+            buckets.setdefault(value, []).append(row)
+            count += len(cells) + 1
+            if count >= self.limit:
+                dump()
+                count = 0
+
+        rows = dict()
+        for value in set(buckets) | set(runs):
+            bucket = sorted(buckets.get(value, []), key=lambda row: row[0])
+            rows[value] = SortedRows(self.columns, runs=runs.get(value, []), rows=bucket)
+
+        head = (head[1], head[2]) if head else None
+        return Selection(self.columns, rows, sort_by=sort_by, head=head)
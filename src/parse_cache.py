@@ -0,0 +1,123 @@
+"""
+Persistent cache of parsed reports.
+
+The result of a parser is stored in an .npz sidecar in a cache directory,
+one per (report path, parser, parser arguments). A sidecar is reused when
+the size and modification time of the report are unchanged, or when they
+changed but the content hash did not.
+
+Parsers must return a tuple of strings and arrays from the array module:
+
+    result = parse_cache.fetch(cachedir, fname, parser, colidx=0)
+"""
+import hashlib
+import os
+import tempfile
+from array import array
+
+import numpy as np
+
+# Bump when the layout of the sidecars changes.
+VERSION = 1
+
+# Bytes read at a time when hashing a report.
+BLOCK = 1024 * 1024
+
+
+def digest(fname):
+    """
+    The content hash of a file.
+    """
+    hasher = hashlib.blake2b(digest_size=20)
+    with open(fname, 'rb') as stream:
+        for block in iter(lambda: stream.read(BLOCK), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def sidecar(cachedir, fname, tag, kwargs):
+    """
+    The path of the sidecar for a report parsed by a parser with the arguments.
+    """
+    params = ",".join(f"{key}={kwargs[key]!r}" for key in sorted(kwargs))
+    ident = f"{VERSION}\0{os.path.abspath(fname)}\0{tag}\0{params}"
+    name = hashlib.blake2b(ident.encode(), digest_size=16).hexdigest()
+    return os.path.join(cachedir, f"{name}.npz")
+
+
+def pack(result):
+    """
+    Turns a parser result into named numpy arrays.
+    """
+    codes, arrays = [], dict()
+    for idx, item in enumerate(result):
+        if isinstance(item, str):
+            codes.append('s')
+            item = item.encode()
+        else:
+            codes.append(item.typecode)
+        arrays[f"item{idx}"] = np.frombuffer(item, dtype=np.uint8)
+    arrays['codes'] = np.array("".join(codes))
+    return arrays
+
+
+def unpack(store):
+    """
+    The parser result stored in a sidecar.
+    """
+    result = []
+    for idx, code in enumerate(str(store['codes'])):
+        data = store[f"item{idx}"].tobytes()
+        if code == 's':
+            result.append(data.decode())
+        else:
+            values = array(code)
+            values.frombytes(data)
+            result.append(values)
+    return tuple(result)
+
+
+def save(path, stamp, hashed, result):
+    """
+    Writes a sidecar, through a temporary file so readers never see a partial one.
+    """
+    folder = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(dir=folder, suffix='.tmp', delete=False) as stream:
+        np.savez(stream, stamp=np.array(stamp, dtype=np.int64), digest=np.array(hashed), **pack(result))
+    os.replace(stream.name, path)
+
+
+def fetch(cachedir, fname, func, tag=None, **kwargs):
+    """
+    Returns func(fname, **kwargs), from the cache when the report is unchanged.
+
+    The tag names the parser in the cache key, defaults to the name of func.
+    """
+    os.makedirs(cachedir, exist_ok=True)
+
+    tag = tag or f"{func.__module__}.{func.__qualname__}"
+    path = sidecar(cachedir, fname, tag, kwargs)
+
+    info = os.stat(fname)
+    stamp = [info.st_size, info.st_mtime_ns]
+    hashed = None
+
+    if os.path.isfile(path):
+        try:
+            with np.load(path, allow_pickle=False) as store:
+                if list(store['stamp']) == stamp:
+                    return unpack(store)
+
+                # The report was touched, check whether the content changed.
+                hashed = digest(fname)
+                if str(store['digest']) == hashed:
+                    result = unpack(store)
+                    save(path, stamp, hashed, result)
+                    return result
+        except (OSError, ValueError, KeyError):
+            # Unreadable sidecars are rebuilt.
+            pass
+
+    result = func(fname, **kwargs)
+    save(path, stamp, hashed or digest(fname), result)
+    return result
@@ -17,6 +17,8 @@ import matplotlib.pylab as plt
 import numpy as np
 import pandas as pd
 
+from src import utils
+
 
 def join(*args):
     return os.path.abspath(os.path.join(*args))
@@ -25,11 +27,11 @@ def join(*args):
 DATA_DIR = join(os.path.dirname(__file__), "data")
 
 
-def plot(df, name, args):
+def plot(df, name, args, colidx=3):
 
     # Plot a heatmap
     if args.type == "heat_map":
-        heatmap(data=df, fname=name)
+        heatmap(data=df, colidx=colidx, fname=name)
 
 
 # colidx is the column where the data starts.
@@ -172,9 +174,12 @@ def main():
         output, ext = os.path.splitext(os.path.basename(fname))
         output = args.output or os.path.join(os.path.dirname(fname), f'{output}_{args.type}.png')
 
-        df = pd.read_csv(filepath_or_buffer=fname, header=0)
+        # Read only the label column and the values, skip the taxid and rank.
+        columns = utils.table_columns(fname)
+        columns = columns[:1] + columns[3:]
+        df = utils.read_table(fname, columns=columns)
 
-        plot(df=df, name=output, args=args)
+        plot(df=df, name=output, args=args, colidx=1)
 
 
 
@@ -1,10 +1,11 @@
 import os
 import sys
 from random import shuffle
-import pandas as pd
 
 import matplotlib
 
+from src import utils
+
 # Is it an interactive plot.
 SHOW_PLOT = '--show' in sys.argv
 
@@ -55,7 +56,7 @@ def generate_plot(files, niter=10, outplot=None, show=False, outfile=None):
     outstream.write(header + '\n')
 
     for fname in files:
-        df = pd.read_csv(fname, sep='\t', header=0)
+        df = utils.read_table(fname, columns=["taxID"], sep='\t')
         column = df["taxID"].tolist()
 
         x = percents
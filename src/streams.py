@@ -0,0 +1,124 @@
+"""
+Opens plain or gzip compressed inputs.
+
+Gzip files are decompressed on a separate thread that fills a bounded
+buffer, so decompression overlaps with the parsing done by the caller.
+Blocks parsed by a process pool are collected through a bounded window
+of pending tasks in the same way.
+"""
+import gzip
+import io
+import os
+import queue
+import threading
+from collections import deque
+
+# Size of the decompressed blocks.
+BLOCK = 4 * 1024 * 1024
+
+# How many blocks may wait in the buffer.
+DEPTH = 8
+
+
+def is_gzip(fname):
+    with open(fname, 'rb') as stream:
+        return stream.read(2) == b'\x1f\x8b'
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Reads a binary stream on a separate thread into a bounded queue.
+    """
+
+    def __init__(self, stream, size=BLOCK, depth=DEPTH):
+        self.queue = queue.Queue(maxsize=depth)
+        self.buffer = memoryview(b'')
+        self.done = False
+        self.thread = threading.Thread(target=self.fill, args=(stream, size), daemon=True)
+        self.thread.start()
+
+    def fill(self, stream, size):
+        try:
+            with stream:
+                while True:
+                    data = stream.read(size)
+                    self.queue.put(data)
+                    if not data:
+                        break
+        except Exception as exc:
+            self.queue.put(exc)
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        if not self.buffer:
+            if self.done:
+                return 0
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if not data:
+                self.done = True
+                return 0
+            self.buffer = memoryview(data)
+
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+def xopen(fname, mode='rt'):
+    """
+    Opens a file for reading, gzip files are decompressed in the background.
+    """
+    if not is_gzip(fname):
+        return open(fname, mode)
+
+    stream = io.BufferedReader(BackgroundReader(gzip.open(fname, 'rb')), buffer_size=BLOCK)
+    if 'b' in mode:
+        return stream
+    return io.TextIOWrapper(stream)
+
+
+def read_blocks(stream, size=BLOCK):
+    """
+    Yields blocks of bytes from a binary stream, each block ends on a newline.
+    """
+    while True:
+        data = stream.read(size)
+        if not data:
+            break
+        # Complete the last line.
+        data += stream.readline()
+        yield data
+
+
+def window(jobs=None):
+    """
+    How many pool tasks may be pending at once, twice the number of processes.
+    """
+    return 2 * (jobs or os.cpu_count() or 1)
+
+
+def imap(pool, func, items, size=None):
+    """
+    Like pool.imap but with at most size tasks submitted and not yet read.
+
+    Pool.imap submits every task up front and keeps the results until they
+    are read, with a slow consumer they pile up in memory. Here the items
+    are only pulled when a result is read. Runs in this process when pool is None.
+    """
+    if pool is None:
+        yield from map(func, items)
+        return
+
+    size = size or window()
+    pending = deque()
+    for item in items:
+        if len(pending) >= size:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
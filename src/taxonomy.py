@@ -0,0 +1,220 @@
+"""
+In memory taxonomy tree built from the NCBI nodes.dmp file.
+
+The tree is stored as NumPy arrays indexed by taxid so that queries
+run over whole batches of taxids at once:
+
+    tree = Taxonomy.load("nodes.dmp", names="names.dmp")
+
+    tree.ancestor_at_rank(taxids, "genus")
+    tree.lineage(taxids)
+    tree.lca(taxids1, taxids2)
+
+Taxid 0 stands for unknown, queries on unknown taxids return 0.
+"""
+import numpy as np
+
+from src import streams
+
+# The ranks reported in lineages, from the top down.
+RANKS = "superkingdom phylum class order family genus species".split()
+
+# Newer taxonomy dumps call the top rank a domain.
+RANK_ALIAS = dict(domain="superkingdom")
+
+
+def split_dmp(line):
+    # Fields are separated by tab|tab and the line ends with tab|
+    return line.rstrip("\t|\n").split("\t|\t")
+
+
+def jump(table):
+    """
+    Follows the pointers in table until they stop changing.
+    """
+    while True:
+        nxt = table[table]
+        if np.array_equal(nxt, table):
+            return table
+        table = nxt
+
+
+class Taxonomy:
+
+    def __init__(self, parent, rank, rank_names, names=None):
+        """
+        parent and rank are arrays indexed by taxid, rank holds indices into rank_names.
+        """
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.rank = np.asarray(rank, dtype=np.int16)
+        self.rank_names = list(rank_names)
+        self.names = names
+        self.size = len(self.parent)
+
+        # The sentinel taxid 0 is its own parent.
+        self.parent[0] = 0
+
+        self.depth = self.compute_depth()
+        self.up = self.compute_lifting()
+
+        # Ancestor tables keyed by rank code.
+        self.rank_tables = dict()
+
+    @classmethod
+    def load(cls, nodes, names=None):
+        """
+        Loads a nodes.dmp and optionally a names.dmp file.
+        """
+        taxids, parents, ranks = [], [], []
+        rank_codes = dict()
+        for line in streams.xopen(nodes):
+            row = split_dmp(line)
+            rank = RANK_ALIAS.get(row[2], row[2])
+            taxids.append(int(row[0]))
+            parents.append(int(row[1]))
+            ranks.append(rank_codes.setdefault(rank, len(rank_codes)))
+
+        taxids = np.array(taxids, dtype=np.int32)
+        size = taxids.max() + 1 if len(taxids) else 1
+
+        parent = np.zeros(size, dtype=np.int32)
+        parent[taxids] = parents
+
+        # Unknown taxids get a rank code that matches no rank.
+        rank_names = list(rank_codes) + ["unknown"]
+        rank = np.full(size, len(rank_codes), dtype=np.int16)
+        rank[taxids] = ranks
+
+        if names:
+            names = cls.load_names(names, size=size)
+
+        return cls(parent=parent, rank=rank, rank_names=rank_names, names=names)
+
+    @staticmethod
+    def load_names(fname, size):
+        """
+        Returns the scientific names as an object array indexed by taxid.
+        """
+        names = np.full(size, "", dtype=object)
+        for line in streams.xopen(fname):
+            row = split_dmp(line)
+            if row[3] == "scientific name":
+                taxid = int(row[0])
+                if taxid < size:
+                    names[taxid] = row[1]
+        return names
+
+    def compute_depth(self):
+        """
+        Distance of each taxid to its root, by pointer jumping.
+        """
+        nodes = np.arange(self.size, dtype=np.int32)
+        table = self.parent.copy()
+        depth = (table != nodes).astype(np.int32)
+        while True:
+            nxt = table[table]
+            if np.array_equal(nxt, table):
+                return depth
+            depth += depth[table]
+            table = nxt
+
+    def compute_lifting(self):
+        """
+        The 2^k-th ancestor of each taxid for the binary lifting in lca().
+        """
+        levels = max(1, int(self.depth.max()).bit_length())
+        up = [self.parent]
+        for _ in range(1, levels):
+            prev = up[-1]
+            up.append(prev[prev])
+        return up
+
+    def index(self, taxids):
+        """
+        Returns the taxids as an array, taxids outside the tree become 0.
+        """
+        taxids = np.asarray(taxids, dtype=np.int64)
+        valid = (taxids >= 0) & (taxids < self.size)
+        return np.where(valid, taxids, 0).astype(np.int32)
+
+    def rank_code(self, rank):
+        rank = RANK_ALIAS.get(rank, rank)
+        return self.rank_names.index(rank) if rank in self.rank_names else -1
+
+    def rank_table(self, rank):
+        """
+        The ancestor at a rank for every taxid, 0 when there is none.
+        """
+        code = self.rank_code(rank)
+        table = self.rank_tables.get(code)
+        if table is None:
+            nodes = np.arange(self.size, dtype=np.int32)
+            # Stop at the taxids of the rank, and at the roots.
+            table = np.where(self.rank == code, nodes, self.parent)
+            table = jump(table)
+            table = np.where(self.rank[table] == code, table, 0).astype(np.int32)
+            self.rank_tables[code] = table
+        return table
+
+    def ancestor_at_rank(self, taxids, rank):
+        """
+        The ancestor (or self) at the rank for each taxid.
+        """
+        return self.rank_table(rank)[self.index(taxids)]
+
+    def lineage(self, taxids, ranks=RANKS):
+        """
+        The ancestors at each rank, one row per taxid and one column per rank.
+        """
+        taxids = self.index(taxids)
+        out = np.zeros((len(taxids), len(ranks)), dtype=np.int32)
+        for col, rank in enumerate(ranks):
+            out[:, col] = self.rank_table(rank)[taxids]
+        return out
+
+    def path(self, taxids):
+        """
+        All ancestors of each taxid, from self up to the root, padded with 0.
+        """
+        taxids = self.index(taxids)
+        width = int(self.depth[taxids].max()) + 1 if len(taxids) else 1
+        out = np.zeros((len(taxids), width), dtype=np.int32)
+        node = taxids
+        for col in range(width):
+            out[:, col] = np.where(self.depth[taxids] >= col, node, 0)
+            node = self.parent[node]
+        return out
+
+    def lca(self, taxids1, taxids2):
+        """
+        The lowest common ancestor of each pair of taxids, 0 when there is none.
+        """
+        a, b = self.index(taxids1), self.index(taxids2)
+        unknown = (a == 0) | (b == 0)
+
+        # Make a the deeper one.
+        swap = self.depth[a] < self.depth[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+
+        # Lift a to the depth of b.
+        diff = self.depth[a] - self.depth[b]
+        for k, up in enumerate(self.up):
+            step = (diff >> k) & 1 == 1
+            a = np.where(step, up[a], a)
+
+        # Lift both to just below their common ancestor.
+        for up in reversed(self.up):
+            ua, ub = up[a], up[b]
+            move = ua != ub
+            a, b = np.where(move, ua, a), np.where(move, ub, b)
+
+        # Taxids in separate trees have no common ancestor.
+        common = np.where(self.parent[a] == self.parent[b], self.parent[a], 0)
+        lca = np.where(a == b, a, common)
+        return np.where(unknown, 0, lca).astype(np.int32)
+
+    def name(self, taxids):
+        """
+        The scientific names of the taxids, requires the names.dmp file.
+        """
+        return self.names[self.index(taxids)]
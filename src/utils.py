@@ -1,3 +1,6 @@
+import os
+import sys
+
 import pandas as pd
 
 
@@ -34,4 +37,94 @@ def alias(df, fname, key1='col1', key2='col2', name='foo', delimiter='\t'):
 def get_subset(df, rank=''):
     indices = df['rank'] == rank
     subset = df[indices] if rank else df
-    return subset
\ No newline at end of file
+    return subset
+
+# Output formats supported by the combiners.
+FORMATS = ['csv', 'parquet', 'feather']
+
+# Label columns that keep their type in the columnar formats.
+LABEL_COLS = {'taxid', 'tax_id', 'size'}
+
+
+def require_pyarrow():
+    try:
+        import pyarrow
+    except ImportError as exc:
+        print(f"*** Error: {exc}", file=sys.stderr)
+        print("*** Run: pip install pyarrow", file=sys.stderr)
+        sys.exit(1)
+
+
+def extension(fmt):
+    return f'.{fmt}'
+
+
+def compact(df):
+    """
+    Stores text columns as categories and value columns as float32.
+    """
+    data = dict()
+    for col in df.columns:
+        values = df[col]
+        if col in LABEL_COLS:
+            data[col] = values
+        elif pd.api.types.is_numeric_dtype(values):
+            data[col] = values.astype('float32')
+        else:
+            data[col] = values.astype('category')
+    return pd.DataFrame(data)
+
+
+def write_table(df, path=None, fmt='csv', **kwargs):
+    """
+    Writes a table as csv, parquet or feather, to standard out when path is not set.
+    """
+    if fmt == 'csv':
+        df.to_csv(path_or_buf=path or sys.stdout, index=False, **kwargs)
+        return
+
+    require_pyarrow()
+
+    df = compact(df).reset_index(drop=True)
+    path = path or sys.stdout.buffer
+    if fmt == 'parquet':
+        df.to_parquet(path, index=False)
+    elif fmt == 'feather':
+        df.to_feather(path)
+    else:
+        raise ValueError(f"Unknown format: {fmt}")
+
+
+def table_format(fname):
+    ext = os.path.splitext(fname)[1].lstrip('.').lower()
+    return ext if ext in FORMATS else 'csv'
+
+
+def table_columns(fname, sep=','):
+    """
+    Returns the column names of a table without reading the data.
+    """
+    fmt = table_format(fname)
+    if fmt == 'parquet':
+        require_pyarrow()
+        import pyarrow.parquet
+        return pyarrow.parquet.read_schema(fname).names
+    if fmt == 'feather':
+        require_pyarrow()
+        import pyarrow.ipc
+        return pyarrow.ipc.open_file(fname).schema.names
+    return list(pd.read_csv(fname, sep=sep, nrows=0).columns)
+
+
+def read_table(fname, columns=None, sep=','):
+    """
+    Reads a csv, parquet or feather table, only the columns listed when set.
+    """
+    fmt = table_format(fname)
+    if fmt == 'parquet':
+        require_pyarrow()
+        return pd.read_parquet(fname, columns=columns)
+    if fmt == 'feather':
+        require_pyarrow()
+        return pd.read_feather(fname, columns=columns)
+    return pd.read_csv(fname, sep=sep, header=0, usecols=columns)